@@ -0,0 +1,47 @@
+# Calibration data store
+# ECEN 404
+
+# Used by cvstereo.py to keep the results of calibration, together with the
+# remap tables derived from them, on disk. The store is a directory holding a
+# version file and one .npy file per array, so that everything can be
+# memory-mapped at startup instead of being recomputed.
+
+import numpy
+import os
+import shutil
+
+
+CALIB_VERSION = 1 # Increment whenever the contents of the store change
+
+
+
+def write_calib_store(path, calib):
+    # Save a dictionary of arrays to the store at path, replacing whatever was
+    # there. The new store is written next to the old one and then renamed, so an
+    # interrupted write never leaves a partial store behind.
+    temp = path + '.tmp'
+    shutil.rmtree(temp, ignore_errors=True)
+    os.makedirs(temp)
+    for name, value in calib.items():
+        numpy.save(os.path.join(temp, name + '.npy'), numpy.asarray(value))
+    with open(os.path.join(temp, 'version'), 'w') as o:
+        o.write('%d\n' % CALIB_VERSION)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(temp, path)
+
+
+
+def read_calib_store(path):
+    # Load the store at path as a dictionary of memory-mapped arrays. Returns
+    # None if there is no store, or if it was written by a different version.
+    try:
+        with open(os.path.join(path, 'version')) as o:
+            if int(o.read()) != CALIB_VERSION:
+                return None
+        calib = {}
+        for fname in os.listdir(path):
+            if fname.endswith('.npy'):
+                calib[fname[:-4]] = numpy.load(os.path.join(path, fname), mmap_mode='r')
+        return calib
+    except (OSError, ValueError):
+        return None
@@ -5,6 +5,14 @@
 # Used by cvstereo.py as a modular camera interface.
 
 import cv2
+import collections
+import threading
+import time
+
+
+RING_SIZE = 4        # Number of frames kept by the background grabber
+GRAB_TIMEOUT = 2.0   # Maximum time (in seconds) to wait for a fresh frame from the grabber
+GRAB_RETRY = 0.05    # Time (in seconds) the grabber waits before reading again after a failed read
 
 
 class CVCamera(object):
@@ -12,17 +20,42 @@ class CVCamera(object):
     def __init__(self, id):
         self.cam = cv2.VideoCapture(id)
         self.do_flip = False
+        self.n = 1
+        self.grabber = None
         assert self.cam.isOpened(), 'Error opening CV camera'
 
     def close(self):
+        self.stop_grabber()
         self.cam.release()
 
-    def capture(self):
-        for i in range(self.n):
-            retval, im = self.cam.read()
-            assert retval, 'Error capturing image with CV camera'
+    def capture(self, after=None):
+        # If the background grabber is running, return the first frame whose
+        # exposure began after the time given by after (as returned by
+        # time.perf_counter(); defaults to now). Otherwise read the camera directly.
+        if self.grabber:
+            im = self.grab(time.perf_counter() if after is None else after)
+        else:
+            for i in range(self.n):
+                retval, im = self.cam.read()
+                assert retval, 'Error capturing image with CV camera'
         return im[::-1, ::-1] if self.do_flip else im
 
+    def capture_sequence(self, n, on_frame):
+        # Capture n frames in a row with the background grabber running, calling
+        # on_frame(i, frame) after each one. Each frame is the first one whose
+        # exposure began after the previous on_frame() returned.
+        started = self.grabber is None
+        if started:
+            self.start_grabber()
+        try:
+            after = time.perf_counter()
+            for i in range(n):
+                on_frame(i, self.capture(after))
+                after = time.perf_counter()
+        finally:
+            if started:
+                self.stop_grabber()
+
     def set_resolution(self, w, h):
         self.cam.set(cv2.CAP_PROP_FRAME_WIDTH, w)
         self.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, h)
@@ -34,6 +67,8 @@ class CVCamera(object):
         # n is the total number of times read() needs to be called
         # for each capture. You'd think it would always be 1, but for
         # the USB camera it's 5 for some screwy reason.
+        # (The reason is that the driver queues up stale frames. This is
+        # not needed while the background grabber is running.)
         self.n = n
 
     def flip(self, do_flip=True):
@@ -41,3 +76,56 @@ class CVCamera(object):
 
 
 
+    # Background frame grabber
+
+    def start_grabber(self, size=RING_SIZE):
+        # Start a thread that reads the camera continuously, so the driver never
+        # queues up stale frames, and keeps the last few frames in a ring buffer.
+        # Each entry is (start, frame), where start is the time the previous frame
+        # was delivered, i.e. the earliest the exposure of this frame could have begun.
+        if self.grabber is None:
+            self.ring = collections.deque(maxlen=size)
+            self.ring_cond = threading.Condition()
+            self.grabbing = True
+            self.grab_error = False
+            self.grabber = threading.Thread(target=self.grab_loop, daemon=True)
+            self.grabber.start()
+
+    def stop_grabber(self):
+        if self.grabber is not None:
+            with self.ring_cond:
+                self.grabbing = False
+            self.grabber.join()
+            self.grabber = None
+
+    def grab_loop(self):
+        start = time.perf_counter()
+        while self.grabbing:
+            retval, im = self.cam.read()
+            end = time.perf_counter()
+            with self.ring_cond:
+                # grab_error only records whether the last read failed, so a
+                # single dropped frame does not fail every capture after it.
+                self.grab_error = not retval
+                if retval:
+                    self.ring.append((start, im))
+                self.ring_cond.notify_all()
+            if not retval:
+                # Don't spin on a camera that has gone away
+                time.sleep(GRAB_RETRY)
+                end = time.perf_counter()
+            start = end
+
+    def grab(self, after):
+        # Wait for the first frame in the ring whose exposure began after the given
+        # time. Failed reads are retried by the grabber until the deadline.
+        deadline = time.perf_counter() + GRAB_TIMEOUT
+        with self.ring_cond:
+            while True:
+                for start, im in self.ring:
+                    if start >= after:
+                        return im
+                remaining = deadline - time.perf_counter()
+                assert remaining > 0 or not self.grab_error, 'Error capturing image with CV camera'
+                assert remaining > 0, 'Timed out waiting for a frame from CV camera'
+                self.ring_cond.wait(remaining)
@@ -5,11 +5,18 @@
 from numpy import *
 from cv2 import *
 import os
+import threading
+import queue
+import hashlib
 
 from .pi_camera import *
 from .cv_camera import *
 from .pcd import *
 from .bench import *
+from .decoder import *
+from .stack import *
+from .calib import *
+from .writer import *
 
 # This backend, which supports stereo calibration and capturing,
 # has been designed to replace the broken backends opencv.py
@@ -23,9 +30,18 @@ Bench.on = False # Disable benchmarking
 
 CALIB_PATH = None # This is where the .png format calibration images and
 # .npy format calibration results are saved.
+CALIB_STORE = '/home/pi/Desktop/DLPScanner/calibration' # This is where calibrate() saves the calibration data
+# and remap tables, which are loaded from here at startup. (Set to None to always use the data below.)
+PATTERN_CACHE = '/home/pi/Desktop/DLPScanner/pattern_cache' # This is where the display-ready projector patterns are cached
+# in .npy format, so they don't have to be generated again on every startup. (Set to None to disable.)
 CAPTURE_PATH = '/home/pi/Desktop/stereo_captures' # This is where the .png format captured images and
 # .npy format pointcloud/disparity data are saved.
-# (These are debug features, and should ultimately be disabled as they waste precious time.)
+# (These are debug features. They are written in the background, so they only cost time once
+# the writer falls behind, but they should ultimately be disabled.)
+CAPTURE_THREADS = 2       # Number of threads writing the CAPTURE_PATH files (0 to write them during the scan instead)
+CAPTURE_QUEUE = 160       # Maximum number of CAPTURE_PATH files waiting to be written, before the scan waits for the writer
+CAPTURE_COMPRESSION = 1   # PNG compression level of the CAPTURE_PATH images, from 0 (fastest) to 9 (smallest)
+CAPTURE_RAW = False       # Save the CAPTURE_PATH images uncompressed in .npy format instead of .png (fastest of all)
 
 REUSE_CALIB_DATA   = False # Debug feature that, if set, loads images from CALIB_PATH rather than capturing them again
 REUSE_CAPTURE_DATA = False # Debug feature that, if set, loads images from CAPTURE_PATH folder rather than capturing them again.
@@ -40,8 +56,21 @@ EVM_BRIGHTNESS = 120   # Corrective factor to dim the brightness of the projecto
 BLACK_THRESH = None    # (Optional) The black threshold of the graycode
 WHITE_THRESH = None    # (Optional) The white threshold of the graycode
 
+DECODER = 'numpy'      # Which graycode decoder to use: 'numpy' (decoder.py) or 'opencv' (structured_light)
+PIPELINE = True        # Grayscale, rectify and decode each frame on a worker thread while the next pattern is captured (requires DECODER = 'numpy')
+RECTIFY_CODES = True   # Decode the raw frames and rectify only the decoded maps, instead of rectifying every frame (requires DECODER = 'numpy')
+
 PRE_DELAY = 50         # The delay (in milliseconds) between the graycode pattern updating and the image being captured
 POST_DELAY = 20        # The delay (in milliseconds) after an image is captured
+LUMA_CAPTURE = True    # Capture only the luma (Y) plane from the Pi camera into a reused buffer, instead of a new BGR array per frame
+BURST_CAPTURE = False  # Capture the whole sequence with the cameras in continuous mode (fixed delays only, SETTLE_DETECT does not apply)
+SYNC_CAPTURE = True    # Trigger both cameras at the same time on separate threads, rather than one after the other
+GRAB_FRAMES = True     # Read the CV camera continuously on a background thread, instead of flushing stale frames on every capture
+
+SETTLE_DETECT = True   # Capture as soon as the projected pattern is stable, using PRE_DELAY + POST_DELAY only as an upper bound
+SETTLE_STEP = 8        # Downsampling factor of the frames compared by the settle detection
+SETTLE_CHANGE = 8.0    # Mean intensity difference from the previous pattern's frame needed to detect a pattern change
+SETTLE_THRESH = 2.0    # Mean intensity difference between successive frames below which the pattern is considered stable
 
 CB_SIZE = (7, 9)       # The size of the chessboard used in calibration
 WIN_SIZE = (11, 11)    # The size of the search window used in calibration
@@ -50,16 +79,25 @@ SQUARE_SIZE = 60.0     # The unit size of the chessboard squares, in mm (or what
 CRITERIA = (TERM_CRITERIA_EPS | TERM_CRITERIA_MAX_ITER, 30, 0.001) # The criteria used in calibration
 
 COORD_THRESH = 6000  # Threshold for pointcloud distance from the origin
+SPARSE_CLOUD = True  # Reproject and filter only the valid pixels, and return an Nx3 pointcloud (with the pixel
+# each point came from in self.cloud_index) rather than a HxWx3 one with the invalid pixels set to infinity
+FILTER_THREADS = 1   # Number of threads used to filter HxWx3 pointclouds (only used if SPARSE_CLOUD is not set)
+OUTLIER_RADIUS = None  # (Optional) Remove the points with fewer than OUTLIER_NEIGHBORS other points within this distance
+OUTLIER_NEIGHBORS = 4  # (This removes small floating clusters of points, which the neighbour filter does not.)
+VOXEL_SIZE = None      # (Optional) Downsample the pointcloud to one point (the mean) per cube of this size
+POINT_BUDGET = None    # (Optional) Downsample the pointcloud to at most this many points
 
 SHOW_PREVIEW = False  # Debug feature that displays a preview of the camera on screen
 MIRROR_PREVIEW = True # Toggles whether or not the preview is mirrored
 FLIP_CAMS = True      # Set to true if the cameras are upside-down
+FUSED_MAPS = True     # Fold the flip into the rectification maps, so snapshot() rectifies the cameras' own frames in one remap
 
 
 
 
 # Data from calibration 4/5/2019
 # Total of 35 calibration data points
+# (Only used if there is no calibration data in CALIB_STORE yet.)
 
 # Intrinsic matrix of first camera
 K1 = \
@@ -117,8 +155,9 @@ array([[ 82.23273968],
 class OpenCV(object):
 
     def __init__(self, master=None):
-        # self.master is unused and currently only exists for modularity purposes
+        # self.master is only used to reach the I/O event loop (see gui())
         self.master = master
+        self.cloud_index = None # The (rows, cols) index of the last sparse pointcloud, if it has one
 
 
 
@@ -126,20 +165,15 @@ class OpenCV(object):
         # Initialize the stereo camera setup
         # First, create the graycode patterns
         self.graycode = structured_light.GrayCodePattern_create(*PROJ_SIZE)
-        retval, self.pattern = self.graycode.generate()
-        assert retval, 'Error generating structured light patterns'
-        black, white = self.graycode.getImagesForShadowMasks(None, None)
-        self.pattern.extend((white, black))
+        self.pattern = self.load_patterns()
+        if DECODER == 'numpy':
+            self.decoder = GrayCodeDecoder(*PROJ_SIZE)
+        else:
+            self.decoder = self.graycode
         if WHITE_THRESH is not None:
-            self.graycode.setWhiteThreshold(WHITE_THRESH)
+            self.decoder.setWhiteThreshold(WHITE_THRESH)
         if BLACK_THRESH is not None:
-            self.graycode.setBlackThreshold(BLACK_THRESH)
-        # Resize the pattern images if necessary
-        if SCREEN_SIZE and (SCREEN_SIZE != PROJ_SIZE):
-            self.pattern = [resize(im, SCREEN_SIZE) for im in self.pattern]
-        if EVM_BRIGHTNESS != 255:
-            for pat in self.pattern:
-                pat[...] = ((pat * float(EVM_BRIGHTNESS)) / 255.0).round()
+            self.decoder.setBlackThreshold(BLACK_THRESH)
         # Initialize the cameras
         self.cam1 = PiCamera()
         self.cam2 = CVCamera(0)
@@ -152,15 +186,41 @@ class OpenCV(object):
         if FLIP_CAMS:
             self.cam1.flip()
             self.cam2.flip()
+        if LUMA_CAPTURE:
+            for cam in (self.cam1, self.cam2):
+                if hasattr(cam, 'set_luma'):
+                    cam.set_luma()
+        if GRAB_FRAMES:
+            for cam in (self.cam1, self.cam2):
+                if hasattr(cam, 'start_grabber'):
+                    cam.start_grabber()
+        # Start the writer for the CAPTURE_PATH files
+        self.writer = FileWriter(CAPTURE_THREADS, CAPTURE_QUEUE, CAPTURE_COMPRESSION, CAPTURE_RAW)
+        # Allocate the frame stacks once, with room for one frame per pattern.
+        shape = (CAM_SIZE[1], CAM_SIZE[0])
+        self.frames1, self.frames2, self.rect1, self.rect2 = [FrameStack(len(self.pattern), shape) for i in range(4)]
+        self.pcd_filter = PcdFilter(shape, numpy.float32, FILTER_THREADS)
+        # The decode order: with RECTIFY_CODES the rect1/rect2 stacks stay empty.
+        self.rectify_codes = RECTIFY_CODES and isinstance(self.decoder, GrayCodeDecoder)
+        # Start the processing pipeline worker
+        self.pipeline = None
+        if PIPELINE and isinstance(self.decoder, GrayCodeDecoder):
+            self.accumulators = [CodeAccumulator(self.decoder, shape) for i in range(2)]
+            self.pipeline = queue.Queue()
+            self.pipeline_error = None
+            self.pipeline_thread = threading.Thread(target=self.pipeline_loop, daemon=True)
+            self.pipeline_thread.start()
         self.clear_frames()
         # Initialize the projector
         if not REUSE_CAPTURE_DATA:
             namedWindow('projector', WINDOW_NORMAL)
             setWindowProperty('projector', WND_PROP_FULLSCREEN, WINDOW_FULLSCREEN)
             waitKey(1)
-        # Rectify if calibration data already exists
-        if K1 is not None:
+        # Load the calibration data if it has been stored, or else rectify from
+        # the data at the top of this file and store the result.
+        if not self.load_calibration() and K1 is not None:
             self.rectify(K1, D1, K2, D2, R, T)
+            self.save_calibration()
         # Otherwise we need to call calibrate() first in this case.
         # Set up the preview
         self.has_preview = self.mirrored_preview = False
@@ -169,125 +229,501 @@ class OpenCV(object):
         
 
 
+    def generate_patterns(self):
+        # Generate the graycode patterns, followed by the white and black images,
+        # ready to be displayed on the projector.
+        retval, pattern = self.graycode.generate()
+        assert retval, 'Error generating structured light patterns'
+        pattern = list(pattern)
+        black, white = self.graycode.getImagesForShadowMasks(None, None)
+        pattern.extend((white, black))
+        # Resize the pattern images if necessary
+        if SCREEN_SIZE and (SCREEN_SIZE != PROJ_SIZE):
+            pattern = [resize(im, SCREEN_SIZE) for im in pattern]
+        if EVM_BRIGHTNESS != 255:
+            for pat in pattern:
+                pat[...] = ((pat * float(EVM_BRIGHTNESS)) / 255.0).round()
+        return pattern
+
+
+    def load_patterns(self):
+        # Return the display-ready patterns from PATTERN_CACHE, memory-mapped, if
+        # they have been cached with the same parameters. Otherwise generate them
+        # and update the cache. The file name is a hash of everything the
+        # patterns depend on, so a changed parameter never loads a stale file.
+        if not PATTERN_CACHE:
+            return self.generate_patterns()
+        key = repr((PROJ_SIZE, SCREEN_SIZE, EVM_BRIGHTNESS, BLACK_THRESH, WHITE_THRESH, getVersionString()))
+        path = os.path.join(PATTERN_CACHE, 'patterns_%s.npy' % hashlib.sha1(key.encode()).hexdigest())
+        w, h = SCREEN_SIZE or PROJ_SIZE
+        shape = (self.graycode.getNumberOfPatternImages() + 2, h, w)
+        try:
+            stack = numpy.load(path, mmap_mode='r')
+            if self.valid_patterns(stack, shape):
+                return list(stack)
+            print('Ignoring invalid pattern cache %s' % path)
+        except FileNotFoundError:
+            pass # Not cached yet
+        except (OSError, ValueError) as e:
+            # A truncated file fails to map
+            print('Ignoring unreadable pattern cache %s: %s' % (path, e))
+        pattern = self.generate_patterns()
+        try:
+            os.makedirs(PATTERN_CACHE, exist_ok=True)
+            for fname in os.listdir(PATTERN_CACHE):
+                if fname.startswith('patterns_'):
+                    os.remove(os.path.join(PATTERN_CACHE, fname)) # Stale
+            # Write to a temporary file first, so an interrupted write never leaves
+            # a truncated cache behind.
+            temp = path + '.tmp'
+            with open(temp, 'wb') as o:
+                numpy.save(o, numpy.array(pattern, numpy.uint8))
+                # Make sure the data is on disk before the rename is, or a crash
+                # could leave an empty file under the final name.
+                o.flush()
+                os.fsync(o.fileno())
+            os.replace(temp, path)
+        except OSError as e:
+            print('Could not cache patterns: %s' % e)
+        return pattern
+
+
+    def valid_patterns(self, stack, shape):
+        # Check a cached pattern stack before it is used: the dtype and shape
+        # (which includes the number of patterns), and that it ends with the
+        # white and black images, which catches a file that has been zeroed.
+        # (Only those two images are read, so the rest stays on disk.)
+        if stack.dtype != numpy.uint8 or stack.shape != shape:
+            return False
+        white, black = stack[-2], stack[-1]
+        return white.min() == white.max() > black.max() == black.min()
+
+
     def quit(self):
-        # Close the cameras and the projector
+        # Close the cameras, the pipeline, the file writer and the projector
         self.cam1.close()
         self.cam2.close()
+        if self.pipeline is not None:
+            self.pipeline.put(None)
+            self.pipeline_thread.join()
+        self.writer.close()
         self.end_preview()
         if not REUSE_CAPTURE_DATA:
             destroyWindow('projector')
 
 
     def clear_frames(self):
-        # Reset the capture frames
-        self.frames1 = []
-        self.frames2 = []
-        self.rect1 = []
-        self.rect2 = []
+        # Reset the capture frames (the stacks themselves are reused, so first
+        # wait until any of them still queued to be saved have been written)
+        self.writer.flush()
+        if self.pipeline is not None:
+            # A failed scan may have left frames with the pipeline worker, and
+            # the error it stopped on; neither belongs to the next scan.
+            self.pipeline.join()
+            self.pipeline_error = None
+        self.frames1.clear()
+        self.frames2.clear()
+        self.rect1.clear()
+        self.rect2.clear()
+        if self.pipeline is not None:
+            for acc in self.accumulators:
+                acc.reset()
+        self.skews = [] # Time difference (in seconds) between the two cameras for each synchronized capture
+        self.settle_times = [] # Time (in seconds) taken by each pattern to settle
+        self.settle_ref = None # Thumbnails of the last captured frames, used to detect pattern changes
 
 
     def rectify(self, K1, D1, K2, D2, R, T):
         # Set up the calibration data
-        R1, R2, P1, P2, self.Q, (x1, y1, w1, h1), (x2, y2, w2, h2) = stereoRectify(K1, D1, K2, D2, CAM_SIZE, R, T)
-        self.map1x, self.map1y = initUndistortRectifyMap(K1, D1, R1, P1, CAM_SIZE, CV_32FC1)
-        self.map2x, self.map2y = initUndistortRectifyMap(K2, D2, R2, P2, CAM_SIZE, CV_32FC1)
+        R1, R2, P1, P2, Q, roi1, roi2 = stereoRectify(K1, D1, K2, D2, CAM_SIZE, R, T)
+        map1x, map1y = initUndistortRectifyMap(K1, D1, R1, P1, CAM_SIZE, CV_32FC1)
+        map2x, map2y = initUndistortRectifyMap(K2, D2, R2, P2, CAM_SIZE, CV_32FC1)
+        fused = FUSED_MAPS and FLIP_CAMS
+        if fused:
+            # Compose the maps with the 180 degree flip. The coordinates are rounded
+            # first, so that INTER_NEAREST picks exactly the same pixels as it
+            # would from the flipped frames.
+            w, h = CAM_SIZE
+            for mapx, mapy in ((map1x, map1y), (map2x, map2y)):
+                mapx[...] = (w - 1) - numpy.rint(mapx)
+                mapy[...] = (h - 1) - numpy.rint(mapy)
+        # Convert the maps to the fixed-point format, which remap() handles faster.
+        # INTER_NEAREST only needs the integer part, so there is no second map.
+        map1, _ = convertMaps(map1x, map1y, CV_16SC2, nninterpolation=True)
+        map2, _ = convertMaps(map2x, map2y, CV_16SC2, nninterpolation=True)
+        self.set_calibration(dict(K1=K1, D1=D1, K2=K2, D2=D2, R=R, T=T, Q=Q, roi1=roi1, roi2=roi2,
+                                  map1=map1, map2=map2, cam_size=CAM_SIZE, fused=fused))
+
+
+    def set_calibration(self, calib):
+        # Use a set of calibration data, as made by rectify() or loaded from CALIB_STORE.
+        self.calib = calib
+        self.Q = numpy.array(calib['Q'])
+        x1, y1, w1, h1 = calib['roi1']
+        x2, y2, w2, h2 = calib['roi2']
         self.roi1 = (slice(y1, y1+h1), slice(x1, x1+w1))
         self.roi2 = (slice(y2, y2+h2), slice(x2, x2+y2))
+        self.map1 = calib['map1']
+        self.map2 = calib['map2']
+        self.reprojector = ReprojectionLUT(self.Q, (CAM_SIZE[1], CAM_SIZE[0]))
+
+
+    def load_calibration(self):
+        # Load (memory-map) the calibration data from CALIB_STORE. Returns False if
+        # there is none, or if it was made for a different CAM_SIZE.
+        calib = read_calib_store(CALIB_STORE) if CALIB_STORE else None
+        if calib is None or tuple(calib['cam_size']) != CAM_SIZE:
+            return False
+        if bool(calib['fused']) != (FUSED_MAPS and FLIP_CAMS):
+            # The maps were made with a different flip setting, so make them again.
+            self.rectify(*[numpy.array(calib[name]) for name in ('K1', 'D1', 'K2', 'D2', 'R', 'T')])
+            self.save_calibration()
+        else:
+            self.set_calibration(calib)
+        return True
 
 
-
-    def capture(self):
-        # Capture a single image with both cameras
-        with Bench('PRE_DELAY'):
-            waitKey(PRE_DELAY)
+    def save_calibration(self):
+        # Save the current calibration data to CALIB_STORE.
+        if CALIB_STORE:
+            try:
+                write_calib_store(CALIB_STORE, self.calib)
+            except OSError as e:
+                print('Could not save calibration data: %s' % e)
+
+
+
+    def gui(self, func, *args):
+        # Call a HighGUI function, or a method using them. The OpenCV windows may
+        # only be used from the main thread, so when the I/O event loop is running
+        # the call is passed to it (see IO.call()).
+        io = getattr(self.master, 'io', None)
+        if io is not None:
+            return io.call(func, *args)
+        return func(*args)
+
+
+
+    def capture_pair(self):
+        # Trigger both cameras at the same time, the right camera on a worker
+        # thread. Return both frames together with the skew (in seconds) between
+        # the moments each camera returned its frame.
+        after = time.perf_counter()
+        result = [None, None]
+        def worker():
+            result[0] = self.cam2.capture(after)
+            result[1] = time.perf_counter()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        frame1 = self.cam1.capture(after)
+        time1 = time.perf_counter()
+        thread.join()
+        frame2, time2 = result
+        assert frame2 is not None, 'Error capturing image with right camera'
+        return frame1, frame2, time2 - time1
+
+
+    def capture_frames(self):
+        # Capture a single raw frame with each camera. Returns (frame1, frame2,
+        # skew), where skew is None unless SYNC_CAPTURE is set.
+        if SYNC_CAPTURE:
+            with Bench('Stereo capture'):
+                return self.capture_pair()
+        after = time.perf_counter()
         with Bench('Left camera capture'):
-            frame1 = self.cam1.capture()
-        with Bench('Resize'):
-            frame1 = resize(frame1, CAM_SIZE)
-        with Bench('Convert'):
-            frame1 = cvtColor(frame1, COLOR_BGR2GRAY)
-        with Bench('Append'):
-            self.frames1.append(frame1)
+            frame1 = self.cam1.capture(after)
         with Bench('Right camera capture'):
-            frame2 = self.cam2.capture()
-        with Bench('Resize'):
-            frame2 = resize(frame2, CAM_SIZE)
+            frame2 = self.cam2.capture(after)
+        return frame1, frame2, None
+
+
+    def thumbnail(self, frame):
+        # Cheap downsampled copy of a raw frame (its green channel, unless it is a
+        # luma frame), for settle detection
+        if frame.ndim == 3:
+            frame = frame[..., 1]
+        return numpy.int16(frame[::SETTLE_STEP, ::SETTLE_STEP])
+
+
+    def capture_settled(self):
+        # Keep capturing until the projected pattern has changed from the previous
+        # one and is stable in both cameras, then return the last frames (with their
+        # skew, as capture_frames()). Gives up and returns the latest frames after
+        # PRE_DELAY + POST_DELAY.
+        start = time.perf_counter()
+        limit = start + (PRE_DELAY + POST_DELAY) / 1000.0
+        changed = False
+        last = None
+        while True:
+            self.gui(waitKey, 1) # Let the projector window update
+            frames = self.capture_frames()
+            thumbs = [self.thumbnail(frame) for frame in frames[:2]]
+            if not changed:
+                changed = all(abs(t - r).mean() > SETTLE_CHANGE for t, r in zip(thumbs, self.settle_ref))
+            elif all(abs(t - l).mean() < SETTLE_THRESH for t, l in zip(thumbs, last)):
+                break
+            last = thumbs
+            if time.perf_counter() >= limit:
+                break
+        self.settle_times.append(time.perf_counter() - start)
+        return frames
+
+
+    def rectify_index(self, k, index):
+        # Rectify a projector index map decoded from the raw frames of camera k.
+        # Decoding is done pixel by pixel, and INTER_NEAREST picks the same source
+        # pixel for every frame, so this gives exactly the same result as decoding
+        # the rectified frames. (The indices are exact in float32.)
+        rect = remap(numpy.float32(index), (self.map1, self.map2)[k], None, INTER_NEAREST, None, BORDER_CONSTANT, -1)
+        return numpy.int32(rect)
+
+
+    def store_frame(self, k, frame, scan=False):
+        # Resize and grayscale a raw frame from camera k (0 or 1) into its stack,
+        # and return the stored frame. If scan is set, the frame is part of a
+        # snapshot() and is kept the way the camera delivered it whenever the maps
+        # include the flip.
+        frames = (self.frames1, self.frames2)[k]
+        if scan and FUSED_MAPS and FLIP_CAMS:
+            # Undo the flipped view, which gives back the camera's contiguous
+            # array, so cvtColor() does not have to copy it first.
+            frame = frame[::-1, ::-1]
+        if frame.shape[1::-1] != CAM_SIZE:
+            with Bench('Resize'):
+                frame = resize(frame, CAM_SIZE)
+        gray = frames.next()
         with Bench('Convert'):
-            frame2 = cvtColor(frame2, COLOR_BGR2GRAY)
-        with Bench('Append'):
-            self.frames2.append(frame2)
-        with Bench('POST_DELAY'):
-            waitKey(POST_DELAY)
-            
-        
+            # Convert straight into the next frame of the stack
+            if frame.ndim == 2:
+                gray[...] = frame # Luma capture, already grayscale
+            else:
+                cvtColor(frame, COLOR_BGR2GRAY, gray)
+        return gray
+
+
+    def decode_frame(self, k, gray):
+        # Fold a stored frame from camera k into that camera's decoder, rectifying
+        # it first unless the decoded maps are rectified instead.
+        if not self.rectify_codes:
+            rect = (self.rect1, self.rect2)[k].next()
+            with Bench('Rectify'):
+                remap(gray, (self.map1, self.map2)[k], None, INTER_NEAREST, rect, BORDER_CONSTANT)
+            gray = rect
+        with Bench('Decode'):
+            self.accumulators[k].add(gray)
+
+
+    def pipeline_loop(self):
+        # Worker thread that processes frames handed over by capture(), while
+        # the main thread goes on to project and capture the next pattern. Each
+        # item holds (k, frame, stored) for both cameras, where stored is set if
+        # capture() has already put the frame in its stack.
+        while True:
+            frames = self.pipeline.get()
+            if frames is None:
+                break
+            try:
+                if self.pipeline_error is None:
+                    for k, frame, stored in frames:
+                        gray = frame if stored else self.store_frame(k, frame, True)
+                        self.decode_frame(k, gray)
+            except Exception as e:
+                self.pipeline_error = e # Reraised by snapshot()
+            finally:
+                self.pipeline.task_done()
+
+
+    def capture(self, scan=False):
+        # Capture a single image with both cameras. If scan is set, the image is
+        # part of a snapshot(): it is captured as soon as the new pattern is stable
+        # (with SETTLE_DETECT) rather than after fixed delays, and handed to the
+        # pipeline worker if there is one. (The first pattern always uses the fixed
+        # delays, since there is nothing to compare it to.)
+        settle = scan and SETTLE_DETECT
+        if settle and self.settle_ref is not None:
+            with Bench('Settle'):
+                frame1, frame2, skew = self.capture_settled()
+        else:
+            with Bench('PRE_DELAY'):
+                self.gui(waitKey, PRE_DELAY)
+            frame1, frame2, skew = self.capture_frames()
+            with Bench('POST_DELAY'):
+                self.gui(waitKey, POST_DELAY)
+        if skew is not None:
+            self.skews.append(skew) # Only for the frames that are kept, not the settle probes
+        if settle:
+            self.settle_ref = [self.thumbnail(frame1), self.thumbnail(frame2)]
+        self.add_frames(frame1, frame2, scan)
+
+
+    def add_frames(self, frame1, frame2, scan=False):
+        # Store a pair of raw frames, or hand them to the pipeline worker if
+        # they are part of a snapshot() and there is one.
+        if scan and self.pipeline is not None:
+            # Luma frames are views of a buffer the camera reuses for its next
+            # capture, so those are stored right away. The worker does the rest.
+            item = []
+            for k, frame in enumerate((frame1, frame2)):
+                if frame.ndim == 2:
+                    item.append((k, self.store_frame(k, frame, scan), True))
+                else:
+                    item.append((k, frame, False))
+            self.pipeline.put(item)
+        else:
+            self.store_frame(0, frame1, scan)
+            self.store_frame(1, frame2, scan)
+
+
+    def project(self):
+        # Generator that drives the projector during a burst capture. Each step
+        # shows the next pattern and waits PRE_DELAY, then yields so that frame
+        # can be captured.
+        for pattern in self.pattern:
+            self.gui(imshow, 'projector', pattern)
+            with Bench('PRE_DELAY'):
+                self.gui(waitKey, PRE_DELAY)
+            yield
+            with Bench('POST_DELAY'):
+                self.gui(waitKey, POST_DELAY)
+
+
+    def capture_burst(self):
+        # Capture the whole pattern sequence with both cameras kept in continuous
+        # mode (capture_sequence()), the right camera on a worker thread. The
+        # projector is advanced from this thread once both cameras have captured
+        # the current pattern, and only then are the next frames captured.
+        n = len(self.pattern)
+        projector = self.project()
+        next(projector) # Show the first pattern
+        frames2 = queue.Queue()
+        advanced = [threading.Event() for i in range(n)]
+        def on_frame2(i, frame):
+            frames2.put((frame, time.perf_counter()))
+            advanced[i].wait()
+        def on_frame1(i, frame1):
+            time1 = time.perf_counter()
+            try:
+                frame2, time2 = frames2.get(timeout=GRAB_TIMEOUT)
+            except queue.Empty:
+                raise AssertionError('Timed out waiting for a frame from the right camera')
+            self.skews.append(time2 - time1)
+            self.add_frames(frame1, frame2, True)
+            next(projector, None)
+            advanced[i].set()
+        thread = threading.Thread(target=self.cam2.capture_sequence, args=(n, on_frame2))
+        thread.start()
+        try:
+            self.cam1.capture_sequence(n, on_frame1)
+        finally:
+            # Never leave the right camera waiting, even if the left one failed
+            for event in advanced:
+                event.set()
+            thread.join()
+        assert len(self.skews) == n, 'Burst capture did not finish'
+
+
+    def load_capture(self, fname):
+        # Load a grayscale frame saved in CAPTURE_PATH, in either .png or raw .npy format
+        path = os.path.join(CAPTURE_PATH, fname)
+        if fname.endswith('.npy'):
+            return numpy.load(path)
+        return cvtColor(imread(path), COLOR_BGR2GRAY)
 
 
     def snapshot(self):
         # Capture and process a sequence of stereo images
         with Bench('Total processing time'):
-            self.pause_preview()
+            self.gui(self.pause_preview)
             # Move the cursor out of the way
             os.system('xdotool mousemove `xdotool getdisplaygeometry`')
             try:
                 
                 self.clear_frames()
+                streamed = False # Whether the frames went through the pipeline
                 if REUSE_CAPTURE_DATA:
                     # Debugging ONLY: Load a sequence of previously captured images
+                    # (with FUSED_MAPS these are saved the way the cameras deliver them,
+                    # so they must have been captured with the same setting)
                     for fname in sorted(os.listdir(CAPTURE_PATH)):
-                        im = imread(os.path.join(CAPTURE_PATH, fname))
                         if fname.startswith('left'):
-                            im = cvtColor(im, COLOR_BGR2GRAY)
-                            self.frames1.append(im)
+                            self.frames1.append(self.load_capture(fname))
                         elif fname.startswith('right'):
-                            im = cvtColor(im, COLOR_BGR2GRAY)
-                            self.frames2.append(im)
+                            self.frames2.append(self.load_capture(fname))
                     if not (self.frames1 and self.frames2):
                         return None # Error signal: haven't previously captured anything
                 else:
                     if self.master.io and self.master.io.is_virtual:
+                        # The virtual I/O window leaves the projector alone during a scan
+                        # (see VGPIO.show_projector()), so make it fullscreen here.
+                        self.gui(setWindowProperty, 'projector', WND_PROP_FULLSCREEN, WINDOW_FULLSCREEN)
                         # Wait for a second so the screen doesn't show up in the first capture
-                        imshow('projector', self.pattern[0])
-                        waitKey(1)
+                        self.gui(imshow, 'projector', self.pattern[0])
+                        self.gui(waitKey, 1)
                         time.sleep(1)
                     # Capture a new sequence of images
-                    for pattern in self.pattern:
-                        imshow('projector', pattern)
-                        self.capture()
+                    streamed = self.pipeline is not None
+                    if BURST_CAPTURE:
+                        self.capture_burst()
+                    else:
+                        for pattern in self.pattern:
+                            self.gui(imshow, 'projector', pattern)
+                            self.capture(True)
+                    if streamed:
+                        # Wait for the pipeline to finish the last frames
+                        with Bench('Pipeline'):
+                            self.pipeline.join()
+                        if self.pipeline_error is not None:
+                            error, self.pipeline_error = self.pipeline_error, None
+                            raise error
+                    if self.skews:
+                        skews = abs(numpy.array(self.skews)) * 1000.0
+                        print('Camera skew: mean %.1f ms, max %.1f ms' % (skews.mean(), skews.max()))
+                    if self.settle_times:
+                        settle = numpy.array(self.settle_times) * 1000.0
+                        print('Settle time: mean %.1f ms, max %.1f ms' % (settle.mean(), settle.max()))
+                        if CAPTURE_PATH:
+                            self.writer.save_array(os.path.join(CAPTURE_PATH, 'settle.npy'), settle)
                     # Save the images if necessary
                     if CAPTURE_PATH:
                         for i, frame in enumerate(self.frames1):
-                            path = os.path.join(CAPTURE_PATH, 'left%.2d.png' % i)
-                            print('Saving %s' % path)
-                            imwrite(path, frame)
+                            self.writer.save_image(os.path.join(CAPTURE_PATH, 'left%.2d.png' % i), frame)
                         for i, frame in enumerate(self.frames2):
-                            path = os.path.join(CAPTURE_PATH, 'right%.2d.png' % i)
-                            print('Saving %s' % path)
-                            imwrite(path, frame)
-                # Rectify the images
-                for frame in self.frames1:
-                    rect = remap(frame, self.map1x, self.map1y, INTER_NEAREST, None, BORDER_CONSTANT)
-                    self.rect1.append(rect)
-                for frame in self.frames2:
-                    rect = remap(frame, self.map2x, self.map2y, INTER_NEAREST, None, BORDER_CONSTANT)
-                    self.rect2.append(rect)
+                            self.writer.save_image(os.path.join(CAPTURE_PATH, 'right%.2d.png' % i), frame)
+                # Rectify the images (unless the pipeline has already done this,
+                # or only the decoded maps are going to be rectified)
+                if not (streamed or self.rectify_codes):
+                    for frame in self.frames1:
+                        remap(frame, self.map1, None, INTER_NEAREST, self.rect1.next(), BORDER_CONSTANT)
+                    for frame in self.frames2:
+                        remap(frame, self.map2, None, INTER_NEAREST, self.rect2.next(), BORDER_CONSTANT)
                 # Save the rectified images if necessary
                 if CAPTURE_PATH:
                     for i, frame in enumerate(self.rect1):
-                        path = os.path.join(CAPTURE_PATH, 'rect_left%.2d.png' % i)
-                        print('Saving %s' % path)
-                        imwrite(path, frame)
+                        self.writer.save_image(os.path.join(CAPTURE_PATH, 'rect_left%.2d.png' % i), frame)
                     for i, frame in enumerate(self.rect2):
-                        path = os.path.join(CAPTURE_PATH, 'rect_right%.2d.png' % i)
-                        print('Saving %s' % path)
-                        imwrite(path, frame)
-                patternImages = [self.rect1[:-2], self.rect2[:-2]]
-                whiteImages = [self.rect1[-2], self.rect2[-2]]
-                blackImages = [self.rect1[-1], self.rect2[-1]]
-                patternImages = numpy.array(patternImages)
-                whiteImages = numpy.array(whiteImages)
-                blackImages = numpy.array(blackImages)
+                        self.writer.save_image(os.path.join(CAPTURE_PATH, 'rect_right%.2d.png' % i), frame)
                 # Decode and reconstruct the pointcloud
-                retval, disparityMap = self.graycode.decode(patternImages, blackImages=blackImages, whiteImages=whiteImages)
+                if streamed or self.rectify_codes:
+                    if streamed:
+                        # The pipeline has already folded every frame into the decoder
+                        index1, index2 = [acc.index() for acc in self.accumulators]
+                    else:
+                        if len(self.frames1) != len(self.pattern) or len(self.frames2) != len(self.pattern):
+                            return None # Error signal - wrong number of images
+                        index1 = self.decoder.decode_camera(self.frames1[:-2], self.frames1[-1], self.frames1[-2])
+                        index2 = self.decoder.decode_camera(self.frames2[:-2], self.frames2[-1], self.frames2[-2])
+                    if self.rectify_codes:
+                        with Bench('Rectify'):
+                            index1 = self.rectify_index(0, index1)
+                            index2 = self.rectify_index(1, index2)
+                    retval = True
+                    disparityMap = self.decoder.disparity(index1, index2)
+                else:
+                    # These are views into the stacks, so no copies are made.
+                    patternImages = [self.rect1[:-2], self.rect2[:-2]]
+                    whiteImages = [self.rect1[-2], self.rect2[-2]]
+                    blackImages = [self.rect1[-1], self.rect2[-1]]
+                    retval, disparityMap = self.decoder.decode(patternImages, blackImages=blackImages, whiteImages=whiteImages)
                 if not retval:
                     return None # Error signal - decode() failed
                 disparityMap = numpy.float32(disparityMap)
@@ -300,28 +736,56 @@ class OpenCV(object):
                 scaledDisparityMap = convertScaleAbs(disparityMap, alpha=alpha)
                 # Use a threshold to remove noise
                 retval, thresh = threshold(scaledDisparityMap, 0, 255, THRESH_OTSU | THRESH_BINARY)
-                # Generate the pointcloud
-                pointcloud = reprojectImageTo3D(disparityMap, self.Q, handleMissingValues=True)
-                # Filter the pointcloud
-                pointcloud[thresh == 0] = numpy.inf
-                pointcloud[(abs(pointcloud) > COORD_THRESH).any(2)] = numpy.inf
-                filter_pcd(pointcloud)
+                if SPARSE_CLOUD:
+                    # Generate the pointcloud, only where the threshold passes
+                    pointcloud, index = self.reprojector.reproject(disparityMap, thresh != 0)
+                    # Filter the pointcloud
+                    pointcloud, index = take_points(pointcloud, index, ~(abs(pointcloud) > COORD_THRESH).any(1))
+                    pointcloud, index = take_points(pointcloud, index, filter_points(pointcloud, index))
+                else:
+                    # Generate the pointcloud
+                    pointcloud = reprojectImageTo3D(disparityMap, self.Q, handleMissingValues=True)
+                    # Filter the pointcloud
+                    pointcloud[thresh == 0] = numpy.inf
+                    pointcloud[(abs(pointcloud) > COORD_THRESH).any(2)] = numpy.inf
+                    self.pcd_filter.filter(pointcloud)
+                    index = None
+                if OUTLIER_RADIUS:
+                    keep = radius_inliers(pointcloud, OUTLIER_RADIUS, OUTLIER_NEIGHBORS)
+                    if SPARSE_CLOUD:
+                        pointcloud, index = take_points(pointcloud, index, keep)
+                    else:
+                        pointcloud[~keep] = numpy.inf
+                if VOXEL_SIZE or POINT_BUDGET:
+                    # The points no longer come from single pixels after this.
+                    if VOXEL_SIZE:
+                        pointcloud = voxel_downsample(pointcloud, VOXEL_SIZE)
+                    if POINT_BUDGET:
+                        pointcloud = downsample_to(pointcloud, POINT_BUDGET)
+                    index = None
+                self.cloud_index = index
                 if FLIP_CAMS:
                     pointcloud[..., 1] = -pointcloud[..., 1]
                 # Save the disparity map and pointcloud, both in NumPy and standard formats, if
-                # that debug flag is turned on.
+                # that debug flag is turned on. (The pointcloud is copied, since the caller
+                # may modify it before it has been written.)
                 if CAPTURE_PATH:
-                    numpy.save(os.path.join(CAPTURE_PATH, 'disparity.npy'), disparityMap)
+                    self.writer.save_array(os.path.join(CAPTURE_PATH, 'disparity.npy'), disparityMap)
                     colorDisparityMap = applyColorMap(scaledDisparityMap, COLORMAP_JET)
-                    imwrite(os.path.join(CAPTURE_PATH, 'disparity.png'), colorDisparityMap)
-                    numpy.save(os.path.join(CAPTURE_PATH, 'pointcloud.npy'), pointcloud)
+                    self.writer.save_image(os.path.join(CAPTURE_PATH, 'disparity.png'), colorDisparityMap)
+                    saved = pointcloud.copy()
+                    self.writer.save_array(os.path.join(CAPTURE_PATH, 'pointcloud.npy'), saved)
+                    if index is not None:
+                        self.writer.save_array(os.path.join(CAPTURE_PATH, 'pointcloud_index.npy'), numpy.array(index))
                     # Save pointcloud in plain text format for debug mode.
-                    save_pcd(pointcloud, os.path.join(CAPTURE_PATH, 'pointcloud.pcd'), binary=False)
+                    self.writer.save_pcd(os.path.join(CAPTURE_PATH, 'pointcloud.pcd'), saved, binary=False)
                 # TODO: error checking
                 return pointcloud
             
             finally:
-                self.resume_preview()
+                self.gui(self.resume_preview)
+                if self.master.io and self.master.io.is_virtual and not REUSE_CAPTURE_DATA:
+                    self.gui(setWindowProperty, 'projector', WND_PROP_FULLSCREEN, WINDOW_NORMAL)
 
 
 
@@ -464,8 +928,12 @@ class OpenCV(object):
         print('T = \\\n%r\n' % T)
         print('# Reprojection error %g' % retval)
         print()
-        # Set up remap and perspective transform data needed by snapshot().
+        # Set up remap and perspective transform data needed by snapshot(), and
+        # store it so it is loaded from now on.
         self.rectify(K1, D1, K2, D2, R, T)
+        self.save_calibration()
+        if CALIB_STORE:
+            print('Calibration data saved to %s' % CALIB_STORE)
             
         
 
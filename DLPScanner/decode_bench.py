@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+# Benchmark for the decode order used by OpenCV.snapshot()
+# ECEN 404
+
+# Compares rectifying every captured frame and then decoding, against
+# decoding the raw frames and rectifying only the two decoded maps
+# (RECTIFY_CODES). The frames in stereo_captures/ stand in for raw frames.
+
+import os
+from DLPScanner.cvstereo import *
+
+CAPTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stereo_captures')
+REPEAT = 10
+
+Bench.on = True
+
+
+def load(prefix):
+    frames = []
+    while True:
+        im = imread(os.path.join(CAPTURE_DIR, '%s%.2d.png' % (prefix, len(frames))), IMREAD_GRAYSCALE)
+        if im is None:
+            return numpy.array(frames)
+        frames.append(im)
+
+
+cv = OpenCV()
+cv.rectify(K1, D1, K2, D2, R, T)
+decoder = GrayCodeDecoder(*PROJ_SIZE)
+frames1 = load('rect_left')
+frames2 = load('rect_right')
+rect1 = numpy.empty_like(frames1)
+rect2 = numpy.empty_like(frames2)
+
+with Bench('Rectify every frame (%d remaps, x%d)' % (len(frames1) + len(frames2), REPEAT)):
+    for i in range(REPEAT):
+        for frame, rect in zip(frames1, rect1):
+            remap(frame, cv.map1, None, INTER_NEAREST, rect, BORDER_CONSTANT)
+        for frame, rect in zip(frames2, rect2):
+            remap(frame, cv.map2, None, INTER_NEAREST, rect, BORDER_CONSTANT)
+index1 = decoder.decode_camera(rect1[:-2], rect1[-1], rect1[-2])
+index2 = decoder.decode_camera(rect2[:-2], rect2[-1], rect2[-2])
+
+raw1 = decoder.decode_camera(frames1[:-2], frames1[-1], frames1[-2])
+raw2 = decoder.decode_camera(frames2[:-2], frames2[-1], frames2[-2])
+with Bench('Rectify decoded maps (2 remaps, x%d)' % REPEAT):
+    for i in range(REPEAT):
+        rectified1 = cv.rectify_index(0, raw1)
+        rectified2 = cv.rectify_index(1, raw2)
+
+assert (index1 == rectified1).all() and (index2 == rectified2).all(), 'Decode orders give different results'
+print('Both decode orders give the same index maps.')
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+# Parity test for the NumPy graycode decoder
+# ECEN 404
+
+# Decodes the rectified images saved in stereo_captures/ with both the
+# OpenCV decoder and decoder.py, and checks that the disparity maps match.
+
+import os
+import numpy
+import cv2
+from DLPScanner.decoder import *
+from DLPScanner.bench import *
+
+CAPTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stereo_captures')
+PROJ_SIZE = (320, 200)
+
+
+def load(prefix):
+    frames = []
+    while True:
+        im = cv2.imread(os.path.join(CAPTURE_PATH, '%s%.2d.png' % (prefix, len(frames))), cv2.IMREAD_GRAYSCALE)
+        if im is None:
+            return frames
+        frames.append(im)
+
+
+rect1 = load('rect_left')
+rect2 = load('rect_right')
+patternImages = numpy.array([rect1[:-2], rect2[:-2]])
+whiteImages = numpy.array([rect1[-2], rect2[-2]])
+blackImages = numpy.array([rect1[-1], rect2[-1]])
+
+graycode = cv2.structured_light.GrayCodePattern_create(*PROJ_SIZE)
+decoder = GrayCodeDecoder(*PROJ_SIZE)
+with Bench('OpenCV decode'):
+    retval1, disparity1 = graycode.decode(patternImages, blackImages=blackImages, whiteImages=whiteImages)
+with Bench('NumPy decode'):
+    retval2, disparity2 = decoder.decode(patternImages, blackImages=blackImages, whiteImages=whiteImages)
+assert retval1 and retval2, 'Decoding failed'
+assert disparity1.shape == disparity2.shape, 'Disparity map shapes differ'
+assert (disparity1 == disparity2).all(), 'Disparity maps differ at %d pixels' % (disparity1 != disparity2).sum()
+# The stored disparity map was produced by the OpenCV decoder during the original scan.
+stored = os.path.join(CAPTURE_PATH, 'disparity.npy')
+if os.path.isfile(stored):
+    assert (numpy.float32(disparity2) == numpy.load(stored)).all(), 'Disparity map differs from disparity.npy'
+print('Disparity maps match (%d valid pixels).' % (disparity2 != 0).sum())
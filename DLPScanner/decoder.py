@@ -0,0 +1,172 @@
+# Vectorized graycode decoder
+# ECEN 404
+
+# Used by cvstereo.py as a drop-in replacement for the OpenCV
+# structured_light.GrayCodePattern.decode() routine.
+
+import numpy
+import threading
+
+
+
+# Default thresholds, the same as the ones used by OpenCV
+DEFAULT_BLACK_THRESH = 40 # Minimum white/black difference for a pixel to not be in shadow
+DEFAULT_WHITE_THRESH = 5  # Minimum pattern/inverse difference for a bit to be trusted
+
+
+
+
+class GrayCodeDecoder(object):
+
+    def __init__(self, width, height):
+        # width, height is the resolution of the projector patterns (PROJ_SIZE)
+        self.width = width
+        self.height = height
+        self.ncols = int(numpy.ceil(numpy.log2(width)))  # Number of column bits
+        self.nrows = int(numpy.ceil(numpy.log2(height))) # Number of row bits
+        self.black_thresh = DEFAULT_BLACK_THRESH
+        self.white_thresh = DEFAULT_WHITE_THRESH
+        self.parallel = True # Decode the two cameras on separate threads
+
+    # Same names as the OpenCV GrayCodePattern, so the two are interchangeable.
+    def setBlackThreshold(self, val):
+        self.black_thresh = val
+
+    def setWhiteThreshold(self, val):
+        self.white_thresh = val
+
+    def getNumberOfPatternImages(self):
+        return 2 * (self.ncols + self.nrows)
+
+
+
+    def gray_to_binary(self, code, nbits):
+        # Convert an array of graycodes to binary in place. Each bit of the
+        # result is the XOR of all the graycode bits above it, which can be done
+        # with log2(nbits) shifts instead of one step per bit.
+        shift = 1
+        while shift < nbits:
+            code ^= code >> shift
+            shift <<= 1
+        return code
+
+
+    def decode_camera(self, patternImages, blackImage, whiteImage):
+        # Decode the pattern stack of a single camera. Returns an HxW int32 array
+        # holding the projector pixel index (column * height + row) seen by each
+        # camera pixel, or -1 wherever the pixel is shadowed or undecodable.
+        acc = CodeAccumulator(self, patternImages[0].shape)
+        for image in patternImages:
+            acc.add(image)
+        acc.add(whiteImage)
+        acc.add(blackImage)
+        return acc.index()
+
+
+    def disparity(self, index1, index2):
+        # Compute the disparity map from the projector indices of both cameras.
+        # Every camera 1 pixel is assigned the mean x coordinate of the camera 2
+        # pixels that saw the same projector pixel, minus the mean x coordinate of
+        # the camera 1 pixels that saw it.
+        n = self.width * self.height
+        means = []
+        for index in (index1, index2):
+            valid = index >= 0
+            x = numpy.nonzero(valid)[1]
+            counts = numpy.bincount(index[valid], minlength=n)
+            sums = numpy.bincount(index[valid], x, minlength=n)
+            means.append((sums, counts))
+        (sums1, counts1), (sums2, counts2) = means
+        ok = (counts1 > 0) & (counts2 > 0)
+        table = numpy.zeros(n, numpy.float64)
+        table[ok] = sums2[ok] / counts2[ok] - sums1[ok] / counts1[ok]
+        disparityMap = numpy.zeros(index1.shape, numpy.float64)
+        valid = index1 >= 0
+        disparityMap[valid] = table[index1[valid]]
+        return disparityMap
+
+
+    def decode(self, patternImages, blackImages=None, whiteImages=None):
+        # Decode both cameras and return (retval, disparityMap), in the same
+        # format as GrayCodePattern.decode().
+        if blackImages is None or whiteImages is None:
+            return False, None
+        for images in patternImages:
+            if len(images) != self.getNumberOfPatternImages():
+                return False, None
+        args = [(patternImages[k], blackImages[k], whiteImages[k]) for k in range(2)]
+        if self.parallel:
+            # NumPy releases the GIL for the bulk operations, so the second
+            # camera can be decoded on a worker thread at the same time.
+            result = [None]
+            def worker():
+                result[0] = self.decode_camera(*args[1])
+            thread = threading.Thread(target=worker)
+            thread.start()
+            index1 = self.decode_camera(*args[0])
+            thread.join()
+            index2 = result[0]
+        else:
+            index1 = self.decode_camera(*args[0])
+            index2 = self.decode_camera(*args[1])
+        return True, self.disparity(index1, index2)
+
+
+
+
+
+
+# Helper class that decodes the images of a single camera one at a time,
+# in the order they are projected, so decoding can run alongside capturing.
+
+class CodeAccumulator(object):
+
+    def __init__(self, decoder, shape):
+        # shape is the (H, W) shape of the camera images
+        self.decoder = decoder
+        self.code = numpy.zeros(shape, numpy.int32)
+        self.error = numpy.zeros(shape, bool)
+        self.diff = numpy.empty(shape, numpy.uint8)
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.last = None
+        self.code.fill(0)
+        self.error.fill(False)
+
+    def add(self, image):
+        # Fold in the next image: each pattern followed by its inverse, then the
+        # white image, then the black image. The bits of every pixel are packed
+        # into a single integer code plane, with the column bits above the row bits.
+        npatterns = self.decoder.getNumberOfPatternImages()
+        assert self.n < npatterns + 2, 'Too many images given to the decoder'
+        if self.n % 2 == 0:
+            self.last = image # Wait for the inverse (or the black image)
+        else:
+            pos, neg = self.last, image
+            # abs(pos - neg) without overflowing the uint8 arrays
+            numpy.subtract(numpy.maximum(pos, neg), numpy.minimum(pos, neg), out=self.diff)
+            if self.n < npatterns:
+                self.code <<= 1
+                self.code |= (pos > neg)
+                self.error |= (self.diff < self.decoder.white_thresh)
+            else:
+                # Shadow mask from the white and black images
+                self.error |= (self.diff <= self.decoder.black_thresh)
+            self.last = None
+        self.n += 1
+
+    def index(self):
+        # Return the projector index map (see GrayCodeDecoder.decode_camera()),
+        # once every image has been added.
+        d = self.decoder
+        assert self.n == d.getNumberOfPatternImages() + 2, 'Not all images have been given to the decoder'
+        # Split the packed code into its row and column parts, and convert each to binary
+        row = d.gray_to_binary(self.code & ((1 << d.nrows) - 1), d.nrows)
+        col = d.gray_to_binary(self.code >> d.nrows, d.ncols)
+        error = self.error | (col >= d.width) | (row >= d.height)
+        col *= d.height
+        col += row
+        col[error] = -1
+        return col
@@ -0,0 +1,71 @@
+# Scan exporter
+# ECEN 404
+
+# Used by gpio.py to hand each scan to the WiFi upload folder, the USB drive
+# and (optionally) an archive folder. The pointcloud is encoded into a .pcd
+# file only once, and then every sink writes the same bytes at the same time,
+# each on its own thread.
+
+import os
+import threading
+import time
+from .pcd import *
+
+
+ARCHIVE_PATH = None # (Optional) Folder where every scan is also saved, named by the time it was taken
+
+
+
+class Exporter(object):
+
+    def __init__(self, master):
+        self.master = master
+        self.sinks = []
+
+    def init(self):
+        self.add_sink('WiFi', self.master.wifi.write)
+        self.add_sink('USB', self.master.usb.write)
+        if ARCHIVE_PATH:
+            self.add_sink('Archive', self.archive)
+
+    def quit(self):
+        pass
+
+    def add_sink(self, name, write):
+        # Register a sink. write(data) is called with the contents of the .pcd
+        # file of every scan, as a bytes object, and should save or send it.
+        self.sinks.append((name, write))
+
+    def export(self, pointcloud):
+        # Encode the pointcloud, and write it to every sink in parallel. Returns
+        # once all of them are done, with a dictionary giving (seconds taken,
+        # exception raised or None) for each sink.
+        start = time.perf_counter()
+        data = encode_pcd(pointcloud, compressed=SEND_COMPRESSED)
+        print('Encoded %d byte pointcloud in %.1f ms' % (len(data), (time.perf_counter() - start) * 1000.0))
+        results = {}
+        def run(name, write):
+            start = time.perf_counter()
+            try:
+                write(data)
+                error = None
+            except Exception as e:
+                error = e
+            results[name] = (time.perf_counter() - start, error)
+            if error is None:
+                print('%s: done in %.1f ms' % (name, results[name][0] * 1000.0))
+            else:
+                print('%s: failed after %.1f ms: %r' % (name, results[name][0] * 1000.0, error))
+        threads = [threading.Thread(target=run, args=sink) for sink in self.sinks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def archive(self, data):
+        # Sink that keeps every scan in ARCHIVE_PATH
+        os.makedirs(ARCHIVE_PATH, exist_ok=True)
+        filename = os.path.join(ARCHIVE_PATH, time.strftime('pointcloud_%Y%m%d_%H%M%S.pcd'))
+        with open(filename, 'wb') as o:
+            o.write(data)
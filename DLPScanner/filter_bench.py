@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Benchmark for the pointcloud noise filter
+# ECEN 404
+
+# Compares PcdFilter, with and without threads, against the original
+# implementation of filter_pcd() (copied below), on the pointcloud in
+# stereo_captures/ and on the unfiltered pointcloud reprojected from the
+# disparity map there. The results must be exactly the same.
+
+import os
+from DLPScanner.cvstereo import *
+
+CAPTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stereo_captures')
+REPEAT = 20
+THREADS = (1, 2, 4)
+
+Bench.on = True
+
+
+def original_filter_pcd(pointcloud, d=2):
+    # filter_pcd() as it was before PcdFilter
+    z = pointcloud[:, :, 2]
+    isinf = numpy.isinf(pointcloud).any(2)
+    counts = numpy.zeros(z.shape, z.dtype)
+    zsum = numpy.zeros(z.shape, z.dtype)
+    ok = ~isinf[:, :-1] & ~isinf[:, 1:]
+    zsum[:, :-1][ok] += abs(z[:, :-1][ok] - z[:, 1:][ok])
+    counts[:, :-1][ok] += 1
+    zsum[:, 1:][ok] += abs(z[:, :-1][ok] - z[:, 1:][ok])
+    counts[:, 1:][ok] += 1
+    ok = ~isinf[:-1, :] & ~isinf[1:, :]
+    zsum[:-1, :][ok] += abs(z[:-1, :][ok] - z[1:, :][ok])
+    counts[:-1, :][ok] += 1
+    zsum[1:, :][ok] += abs(z[:-1, :][ok] - z[1:, :][ok])
+    counts[1:, :][ok] += 1
+    isinf |= (counts == 0)
+    if isinf.all():
+        pointcloud.fill(numpy.inf)
+        return
+    means = numpy.empty(z.shape, z.dtype)
+    means[~isinf] = zsum[~isinf] / counts[~isinf]
+    mean = means[~isinf].mean()
+    std = means[~isinf].std()
+    norm = (means - mean) / std
+    isinf |= (abs(norm) > d)
+    pointcloud[isinf] = numpy.inf
+
+
+cv = OpenCV()
+cv.rectify(K1, D1, K2, D2, R, T)
+disparityMap = numpy.float32(numpy.load(os.path.join(CAPTURE_DIR, 'disparity.npy')))
+reprojected = reprojectImageTo3D(disparityMap, cv.Q, handleMissingValues=True)
+reprojected[(abs(reprojected) > COORD_THRESH).any(2)] = numpy.inf
+clouds = [('pointcloud.npy', numpy.load(os.path.join(CAPTURE_DIR, 'pointcloud.npy'))),
+          ('reprojected disparity.npy', reprojected)]
+
+for name, cloud in clouds:
+    print('%s (%d points):' % (name, numpy.count_nonzero(~numpy.isinf(cloud).any(2))))
+    with Bench('  original filter_pcd (x%d)' % REPEAT):
+        for i in range(REPEAT):
+            expected = cloud.copy()
+            original_filter_pcd(expected)
+    for threads in THREADS:
+        pcd_filter = PcdFilter(cloud.shape[:2], cloud.dtype, threads)
+        with Bench('  PcdFilter, %d thread%s (x%d)' % (threads, '' if threads == 1 else 's', REPEAT)):
+            for i in range(REPEAT):
+                result = cloud.copy()
+                pcd_filter.filter(result)
+        assert numpy.array_equal(result, expected, equal_nan=True), 'PcdFilter gives a different result'
+print('All filters give the same pointclouds.')
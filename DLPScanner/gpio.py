@@ -10,6 +10,8 @@ else:
     import RPi.GPIO as GPIO
 
 import os
+import queue
+import threading
 import time
 
 
@@ -31,6 +33,43 @@ ERROR_LED = 24
 AUTO_TIMER = 0
 
 
+# Maximum number of snapshot requests waiting for the scanner. Button presses
+# beyond this while a scan is running are ignored.
+SCAN_QUEUE = 2
+
+
+BOUNCE_TIME = 200  # Time (in milliseconds) after a button press during which further presses are ignored
+PREVIEW_TIME = .05 # Time (in seconds) between preview frames, and between updates of the virtual I/O window
+
+
+
+
+
+
+class Call(object):
+    # A function call passed to the main thread's event loop by IO.call()
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = self.error = None
+        self.done = threading.Event()
+
+    def __call__(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e # Reraised by wait()
+        finally:
+            self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
 
 
 
@@ -39,8 +78,14 @@ class IO(object):
 
     def __init__(self, master):
         self.master = master
-        self.snapshot_reset = False # Flag to make sure only one button press is detected per "click"
+        self.events = queue.Queue() # Channels of the buttons pressed and LEDs to be updated, and calls from the workers, for the event loop
         self.is_virtual = IS_VIRTUAL
+        self.busy = 0 # Number of tasks currently keeping the busy light lit
+        self.busy_lock = threading.Lock()
+        self.scan_lock = threading.Lock() # Held while the projector and cameras are in use
+        self.scan_queue = queue.Queue(SCAN_QUEUE)
+        self.export_queue = queue.Queue()
+        self.workers = []
 
     def init(self):
         GPIO.setmode(GPIO.BCM)
@@ -49,42 +94,112 @@ class IO(object):
         GPIO.setup(SNAPSHOT_BUTTON, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
         GPIO.setup([POWER_LED, WIFI_LED, USB_LED, BUSY_LED, ERROR_LED], GPIO.OUT, initial=GPIO.LOW)
         GPIO.output(POWER_LED, GPIO.HIGH) # Power LED should always be lit
+        if self.is_virtual:
+            GPIO.window_lock = self.scan_lock # See VGPIO.show_projector()
+        # Buttons are detected on their rising edge, and passed to the event loop
+        GPIO.add_event_detect(EJECT_BUTTON, GPIO.RISING, callback=self.post, bouncetime=BOUNCE_TIME)
+        GPIO.add_event_detect(SNAPSHOT_BUTTON, GPIO.RISING, callback=self.post, bouncetime=BOUNCE_TIME)
+        # Scans run as a two stage pipeline, so the main loop never blocks on them:
+        # the scan worker captures and processes each requested snapshot, then hands
+        # the pointcloud to the export worker, and is free to start the next capture
+        # while the previous one is still being sent to WiFi/USB.
+        self.workers = [threading.Thread(target=self.scan_loop, daemon=True),
+                        threading.Thread(target=self.export_loop, daemon=True)]
+        for worker in self.workers:
+            worker.start()
 
     def quit(self):
+        # Finish any scans that are already queued, then stop the workers
+        if self.workers:
+            self.wait(self.scan_queue)
+            self.scan_queue.put(None)
+            self.workers[0].join()
+            self.export_queue.put(None)
+            self.workers[1].join()
+            self.workers = []
         GPIO.cleanup()
 
+    # The busy light is shared by the main loop and the workers, so it is
+    # reference counted: it stays lit until every start_busy() has been ended.
+
     def start_busy(self):
-        GPIO.output(BUSY_LED, GPIO.HIGH)
+        with self.busy_lock:
+            self.busy += 1
+            GPIO.output(BUSY_LED, GPIO.HIGH)
 
     def end_busy(self):
-        GPIO.output(BUSY_LED, GPIO.LOW)
+        with self.busy_lock:
+            self.busy = max(self.busy - 1, 0)
+            if not self.busy:
+                GPIO.output(BUSY_LED, GPIO.LOW)
 
 
     def snapshot(self):
-        # Call .master.opencv.snapshot(), make appropriate GPIO calls,
-        # and save image to USB/transmit via WiFi if applicable.
-        self.start_busy()
-        GPIO.output(ERROR_LED, GPIO.LOW)
-        # This function blocks. No LEDs will update while the image data is being
-        # captured and processed.
-        data = self.master.opencv.snapshot()
-        self.end_busy()
-        GPIO.output(ERROR_LED, GPIO.HIGH if data is None else GPIO.LOW)
-        if data is not None:
-            self.master.wifi.send(data)
-            self.master.usb.send(data)
+        # Request a snapshot from the scan worker. This returns immediately, with
+        # False if too many snapshots are already waiting.
+        try:
+            self.scan_queue.put_nowait(True)
+            return True
+        except queue.Full:
+            print('Scanner busy, snapshot ignored')
+            return False
+
+
+    def scan_loop(self):
+        # Scan worker: call .master.opencv.snapshot() for each request, make the
+        # appropriate GPIO calls, and pass the result on to the export worker.
+        while True:
+            job = self.scan_queue.get()
+            try:
+                if job is None:
+                    return
+                self.start_busy()
+                GPIO.output(ERROR_LED, GPIO.LOW)
+                try:
+                    with self.scan_lock:
+                        data = self.master.opencv.snapshot()
+                except Exception as e:
+                    # Keep the worker alive for the next snapshot
+                    print('Error during snapshot: %r' % e)
+                    data = None
+                self.end_busy()
+                GPIO.output(ERROR_LED, GPIO.HIGH if data is None else GPIO.LOW)
+                if data is not None:
+                    self.export_queue.put(data)
+            finally:
+                # The export is queued before this, so once scan_queue.join()
+                # returns, export_queue.join() waits for every requested scan.
+                self.scan_queue.task_done()
+
+
+    def export_loop(self):
+        # Export worker: save the pointcloud to USB/transmit via WiFi if applicable.
+        while True:
+            data = self.export_queue.get()
+            try:
+                if data is None:
+                    return
+                self.master.exporter.export(data)
+            except Exception as e:
+                print('Error during export: %r' % e)
+            finally:
+                self.export_queue.task_done()
 
 
     def eject(self):
-        # Eject USB storage device
+        # Eject USB storage device, once any pending exports have been written to it
         self.start_busy()
+        self.wait(self.export_queue)
         self.master.usb.eject()
         self.end_busy()
 
 
     def shutdown(self):
-        # Shut the Raspberry Pi down
+        # Shut the Raspberry Pi down, once the scans that have already been
+        # requested have been taken and exported
         self.start_busy()
+        self.wait(self.scan_queue)
+        self.wait(self.export_queue)
         os.system('sudo shutdown -r now')
         # Don't call end_busy(); wait for the Pi to completely turn off.
 
@@ -97,31 +212,80 @@ class IO(object):
             time.sleep(.2)
             self.end_busy()
             time.sleep(.8)
-        # Do the capture
+        # Request the capture
         self.snapshot()
 
 
+    def post(self, channel):
+        # Pass an event to the event loop. This may be called from any thread:
+        # channel is either a button that has been pressed, or an LED that needs
+        # to be updated.
+        self.events.put(channel)
+
+
+    def call(self, func, *args):
+        # Run func(*args) on the main thread and return its result. The OpenCV
+        # windows may only be used from the main thread, so the scan worker passes
+        # its HighGUI calls to the event loop this way.
+        if threading.current_thread() is threading.main_thread():
+            return func(*args)
+        call = Call(func, args)
+        self.events.put(call)
+        return call.wait()
+
+
+    def wait(self, q):
+        # Wait until every item put on q has been processed, like q.join(), but
+        # keep running the workers' calls (see call()) meanwhile, since they may
+        # be waiting on them. Any other events are handled after this returns.
+        deferred = []
+        while q.unfinished_tasks:
+            try:
+                event = self.events.get(timeout=PREVIEW_TIME)
+            except queue.Empty:
+                continue
+            if isinstance(event, Call):
+                event()
+            else:
+                deferred.append(event)
+        for event in deferred:
+            self.events.put(event)
+
+
     def run(self):
-        # Main I/O event loop
+        # Main I/O event loop. Instead of polling, this sleeps until a button is
+        # pressed, a USB drive comes or goes or the WiFi connection changes,
+        # only waking up regularly to update the preview when it is shown.
         if AUTO_TIMER:
             self.auto_timer(AUTO_TIMER)
+        self.master.usb.watch(lambda connected: self.post(USB_LED))
+        self.master.wifi.watch(lambda connected: self.post(WIFI_LED))
         while True:
-            # Check for the presence of WiFi connections and USB drives.
-            GPIO.output(WIFI_LED, GPIO.HIGH if self.master.wifi.connected() else GPIO.LOW)
-            GPIO.output(USB_LED, GPIO.HIGH if self.master.usb.connected() else GPIO.LOW)
-            if GPIO.input(SNAPSHOT_BUTTON) == GPIO.HIGH:
-                if not self.snapshot_reset:
-                    self.snapshot_reset = True
-                    self.snapshot()
-            else:
-                self.snapshot_reset = False
-            if GPIO.input(EJECT_BUTTON) == GPIO.HIGH:
-                if self.usb.connected():
+            preview = getattr(self.master.opencv, 'has_preview', False)
+            try:
+                event = self.events.get(timeout=PREVIEW_TIME if preview or self.is_virtual else None)
+            except queue.Empty:
+                event = None
+            if isinstance(event, Call):
+                event()
+            elif event == SNAPSHOT_BUTTON:
+                self.snapshot()
+            elif event == EJECT_BUTTON:
+                if self.master.usb.connected():
                     self.eject()
                 else:
                     self.shutdown()
-            if hasattr(self.master.opencv, 'update'):
-                self.master.opencv.update()
-            time.sleep(.05) # Keep the processor from using up too much CPU time
+            elif event == USB_LED:
+                GPIO.output(USB_LED, GPIO.HIGH if self.master.usb.connected() else GPIO.LOW)
+            elif event == WIFI_LED:
+                GPIO.output(WIFI_LED, GPIO.HIGH if self.master.wifi.connected() else GPIO.LOW)
+            # The preview is paused while a scan is using the cameras.
+            if preview and hasattr(self.master.opencv, 'update') and self.scan_lock.acquire(False):
+                try:
+                    self.master.opencv.update()
+                finally:
+                    self.scan_lock.release()
+            if self.is_virtual:
+                GPIO.update()
         
 
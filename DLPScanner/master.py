@@ -5,6 +5,7 @@
 from .gpio import IO
 from .wifi import WiFi
 from .usb import USB
+from .export import Exporter
 from .cvstereo import OpenCV # May also use opencv or pyimage, but these currently do not work properly.
 
 
@@ -17,6 +18,7 @@ class Master(object):
         self.wifi = WiFi(self)
         self.usb = USB(self)
         self.opencv = OpenCV(self)
+        self.exporter = Exporter(self)
         self.on = False
 
     def __del__(self):
@@ -28,6 +30,7 @@ class Master(object):
         self.io.start_busy() # Busy light is lit while device is booting
         self.wifi.init()
         self.usb.init()
+        self.exporter.init()
         self.opencv.init()
         self.io.end_busy()
         self.on = True
@@ -36,6 +39,7 @@ class Master(object):
         self.io.quit()
         self.wifi.quit()
         self.usb.quit()
+        self.exporter.quit()
         self.opencv.quit()
         self.on = False
 
@@ -1,23 +1,60 @@
-# Operations on pointclouds (HxWx3 NumPy arrays of floating point values)
+# Operations on pointclouds (HxWx3 or Nx3 NumPy arrays of floating point values)
 # Matthew Kroesche
 # ECEN 404
 
 import numpy
+import os
+import struct
+import threading
 
+try:
+    import lzf # python-lzf, for binary_compressed .pcd files
+except ImportError:
+    lzf = None # Use the (much slower) pure Python versions below instead
 
 
-def save_pcd(pointcloud, filename, binary=True):
-    # Save a pointcloud in .pcd format
+SEND_COMPRESSED = False # Whether WiFi.send() and USB.send() save binary_compressed files
+# (smaller, but only worth it when python-lzf is installed, and not yet checked
+# against the remote application's PCDLoader)
+ASCII_POINTS = 4096 # Number of points formatted at once when saving ASCII .pcd files
+BINARY_POINTS = 65536 # Number of points written at once when saving binary .pcd files
+
+
+
+def save_pcd(pointcloud, filename, binary=True, compressed=False):
+    # Save a pointcloud in .pcd format (see pcd_chunks()). The file is written a
+    # chunk at a time, so it never has to be held in memory as a whole.
     with open(filename, 'wb') as o:
-        if pointcloud.ndim == 2:
-            h = 1
-            w = pointcloud.shape[0]
-        else:
-            h, w = pointcloud.shape[:2]
-        points = pointcloud.reshape(w*h, 3)
-        points = points[~numpy.isinf(points).any(1)]
-        # Header
-        o.write(b'''VERSION 0.7
+        for chunk in pcd_chunks(pointcloud, binary, compressed):
+            o.write(chunk)
+
+
+
+def encode_pcd(pointcloud, binary=True, compressed=False):
+    # Return a pointcloud in .pcd format, as a bytes object (see pcd_chunks()).
+    # Use save_pcd() instead to write it to a file.
+    return b''.join(pcd_chunks(pointcloud, binary, compressed))
+
+
+
+def pcd_chunks(pointcloud, binary=True, compressed=False):
+    # Generate the contents of a .pcd file holding a pointcloud, as a sequence of
+    # bytes objects: the header, then the data a chunk of points at a time. If
+    # compressed is set, the data is saved in the binary_compressed format (LZF
+    # compressed, one field after another), which is compressed as a whole.
+    if pointcloud.ndim == 2:
+        h = 1
+        w = pointcloud.shape[0]
+    else:
+        h, w = pointcloud.shape[:2]
+    points = pointcloud.reshape(w*h, 3)
+    points = points[~numpy.isinf(points).any(1)]
+    if compressed:
+        format = b'binary_compressed'
+    else:
+        format = b'binary' if binary else b'ascii'
+    # Header
+    yield b'''VERSION 0.7
 FIELDS x y z
 SIZE 4 4 4
 TYPE F F F
@@ -26,69 +63,613 @@ WIDTH %d
 HEIGHT %d
 VIEWPOINT 0 0 0 1 0 0 0
 POINTS %d
-DATA %b
-''' % (w, h, len(points), b'binary' if binary else b'ascii'))
-        if binary:
-            # Binary data
-            points.tofile(o)
-        else:
-            # ASCII data
-            for point in points:
-                o.write(b'%g %g %g\n' % tuple(point))
+DATA %s
+''' % (w, h, len(points), format)
+    if compressed:
+        # Compressed data: the sizes, followed by all the x values, then all the y, then all the z
+        data = numpy.ascontiguousarray(points.T, '<f4').tobytes()
+        packed = lzf_compress(data)
+        yield struct.pack('<II', len(packed), len(data))
+        yield packed
+    elif binary:
+        # Binary data
+        points = numpy.ascontiguousarray(points, '<f4')
+        for start in range(0, len(points), BINARY_POINTS):
+            yield points[start:start+BINARY_POINTS].tobytes()
+    else:
+        # ASCII data, formatted a chunk of points at a time
+        for start in range(0, len(points), ASCII_POINTS):
+            chunk = points[start:start+ASCII_POINTS]
+            yield (b'%g %g %g\n' * len(chunk)) % tuple(chunk.ravel().tolist())
+
+
+
+def load_pcd(filename, organized=False, mmap=False):
+    # Load a pointcloud from .pcd format. Return the Nx3 NumPy array of its x, y
+    # and z fields, or the HxWx3 array if organized is set and the file holds an
+    # organized pointcloud. If mmap is set and the file holds nothing else, in
+    # binary format, the array is a read-only memory map of the file rather than
+    # a copy (which keeps the file open for as long as the array is in use).
+    cloud = read_pcd(filename, organized, mmap)
+    xyz = numpy.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+    if cloud.dtype == xyz:
+        return cloud.view('<f4').reshape(cloud.shape + (3,))
+    return numpy.stack([cloud['x'], cloud['y'], cloud['z']], -1).astype(numpy.float32)
+
+
+
+# Full .pcd reader
+
+
+PCD_TYPES = {'F': 'f', 'I': 'i', 'U': 'u'} # NumPy type codes of the .pcd TYPE values
+ASCII_CHUNK = 1 << 22 # Number of bytes of ASCII data parsed at once
 
 
+def read_pcd_header(o):
+    # Read the header of a .pcd file from the open file o, leaving it at the
+    # start of the data. Returns a dictionary of the header values.
+    values = {}
+    while True:
+        line = o.readline()
+        assert line, 'No DATA line in .pcd file'
+        words = line.decode('ascii').split()
+        if not words or words[0].startswith('#'):
+            continue # Blank line or comment
+        values[words[0].upper()] = words[1:]
+        if words[0].upper() == 'DATA':
+            break
+    fields = values['FIELDS']
+    n = len(fields)
+    header = dict(fields=fields,
+                  size=[int(v) for v in values.get('SIZE', [4]*n)],
+                  type=[v.upper() for v in values.get('TYPE', ['F']*n)],
+                  count=[int(v) for v in values.get('COUNT', [1]*n)],
+                  width=int(values['WIDTH'][0]),
+                  height=int(values.get('HEIGHT', [1])[0]),
+                  viewpoint=[float(v) for v in values.get('VIEWPOINT', [0, 0, 0, 1, 0, 0, 0])],
+                  data=values['DATA'][0].lower(),
+                  offset=o.tell())
+    header['points'] = int(values.get('POINTS', [header['width'] * header['height']])[0])
+    assert header['data'] in ('ascii', 'binary', 'binary_compressed'), 'Unknown .pcd data format'
+    return header
 
-def load_pcd(filename):
-    # Load a pointcloud from .pcd format. Return the Nx3 NumPy array.
+
+def pcd_dtype(header):
+    # Return the NumPy structured type of one point of a .pcd file. Unnamed
+    # (padding) fields, called _, are renamed so that the names are unique.
+    names = []
+    formats = []
+    for i, name in enumerate(header['fields']):
+        if name == '_' or name in names:
+            name = '_%d' % i
+        format = '<%s%d' % (PCD_TYPES[header['type'][i]], header['size'][i])
+        names.append(name)
+        formats.append((format, (header['count'][i],)) if header['count'][i] > 1 else format)
+    return numpy.dtype(dict(names=names, formats=formats))
+
+
+def read_pcd(filename, organized=True, mmap=False):
+    # Read a .pcd file with any fields. Returns a NumPy structured array with one
+    # element per point, of shape (HEIGHT, WIDTH) if the file holds an organized
+    # pointcloud (and organized is set) or (POINTS,) otherwise. If mmap is set,
+    # binary data is memory-mapped (read-only) instead of being read.
     with open(filename, 'rb') as o:
-        n = 0
-        while True:
-            line = o.readline().split()
-            if line[0] == b'POINTS':
-                n = int(line[1])
-            if line[0] == b'DATA':
-                format = line[1]
-                assert format in (b'ascii', b'binary')
-                pointcloud = numpy.fromfile(o, numpy.float32, n*3, ('' if format == b'binary' else ' '))
-                return pointcloud.reshape((n, 3))
-                
-        
-
-def filter_pcd(pointcloud, d=2):
+        header = read_pcd_header(o)
+        dtype = pcd_dtype(header)
+        n = header['points']
+        if header['data'] == 'binary':
+            assert os.path.getsize(filename) >= header['offset'] + n * dtype.itemsize, 'Not enough points in .pcd file'
+            if mmap:
+                cloud = numpy.memmap(filename, dtype, 'r', header['offset'], (n,))
+            else:
+                cloud = numpy.fromfile(o, dtype, n)
+        elif header['data'] == 'binary_compressed':
+            # The fields are stored one after another
+            size, length = struct.unpack('<II', o.read(8))
+            data = lzf_decompress(o.read(size), length)
+            assert length == n * dtype.itemsize, 'Wrong amount of data in .pcd file'
+            cloud = numpy.empty(n, dtype)
+            start = 0
+            for name in dtype.names:
+                field = dtype.fields[name][0]
+                cloud[name] = numpy.frombuffer(data, field.base, n * field.itemsize // field.base.itemsize, start).reshape((n,) + field.shape)
+                start += n * field.itemsize
+        else:
+            cloud = numpy.empty(n, dtype)
+            parse_ascii(o, cloud)
+    w, h = header['width'], header['height']
+    if organized and h > 1 and w * h == n:
+        cloud = cloud.reshape((h, w))
+    return cloud
+
+
+def parse_ascii(o, cloud):
+    # Parse the ASCII data of a .pcd file into the structured array cloud, a
+    # chunk of complete lines at a time.
+    columns = [(name, cloud.dtype.fields[name][0].shape) for name in cloud.dtype.names]
+    ncols = sum(int(numpy.prod(shape)) for name, shape in columns)
+    n = len(cloud)
+    row = 0
+    while row < n:
+        chunk = o.read(ASCII_CHUNK)
+        if not chunk:
+            break
+        if not chunk.endswith(b'\n'):
+            chunk += o.readline()
+        values = numpy.fromstring(chunk, numpy.float64, sep=' ')
+        assert len(values) % ncols == 0, 'Wrong number of values in .pcd file'
+        values = values.reshape((-1, ncols))[:n-row]
+        rows = cloud[row:row+len(values)]
+        col = 0
+        for name, shape in columns:
+            k = int(numpy.prod(shape))
+            rows[name] = values[:, col:col+k].reshape((len(values),) + shape)
+            col += k
+        row += len(values)
+    assert row == n, 'Not enough points in .pcd file'
+
+
+# LZF compression, as used by binary_compressed .pcd files.
+# The data is a sequence of literal runs (a control byte below 32 giving the
+# length minus 1, then that many bytes) and back references (3 bits of length
+# and 13 bits of distance to an earlier copy of the bytes, in 2 or 3 bytes).
+
+
+def lzf_compress(data):
+    # Compress a bytes object with LZF
+    if lzf is not None and data:
+        # Incompressible data can grow by up to 1 byte in 32
+        return lzf.compress(data, len(data) + len(data)//32 + 2)
+    # The table is keyed by slices of data, which must be hashable, so data is
+    # kept as bytes (a str in Python 2, whose items are characters rather than
+    # integers; they are only ever compared with each other here).
+    data = bytes(data)
+    out = bytearray()
+    n = len(data)
+    table = {} # Last position of every 3 byte sequence
+    start = 0  # Start of the pending literal run
+    i = 0
+    def literals(end):
+        for k in range(start, end, 32):
+            run = data[k:min(k+32, end)]
+            out.append(len(run) - 1)
+            out.extend(run)
+    while i < n - 2:
+        key = data[i:i+3]
+        ref = table.get(key)
+        table[key] = i
+        if ref is None or i - ref > 8192:
+            i += 1
+            continue
+        # Extend the match as far as possible (up to 264 bytes)
+        length = 3
+        limit = min(264, n - i)
+        while length < limit and data[ref+length] == data[i+length]:
+            length += 1
+        literals(i)
+        offset = i - ref - 1
+        if length < 9:
+            out.append(((length - 2) << 5) | (offset >> 8))
+        else:
+            out.append(0xe0 | (offset >> 8))
+            out.append(length - 9)
+        out.append(offset & 0xff)
+        i += length
+        start = i
+    literals(n)
+    return bytes(out)
+
+
+def lzf_decompress(data, length):
+    # Decompress LZF data, which must decompress to the given number of bytes
+    if lzf is not None and length:
+        out = lzf.decompress(data, length)
+        assert out is not None and len(out) == length, 'Corrupt LZF data'
+        return out
+    # Index a bytearray, whose items are integers in Python 2 as well
+    data = bytearray(data)
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        ctrl = data[i]
+        i += 1
+        if ctrl < 32:
+            # Literal run
+            out += data[i:i+ctrl+1]
+            i += ctrl + 1
+        else:
+            # Back reference
+            n = ctrl >> 5
+            if n == 7:
+                n += data[i]
+                i += 1
+            ref = len(out) - ((ctrl & 0x1f) << 8) - data[i] - 1
+            i += 1
+            n += 2
+            assert ref >= 0, 'Corrupt LZF data'
+            while n > 0:
+                # The reference may overlap the bytes being written
+                chunk = out[ref:ref+n]
+                out += chunk
+                ref += len(chunk)
+                n -= len(chunk)
+    assert len(out) == length, 'Corrupt LZF data'
+    return bytes(out)
+
+
+
+def filter_pcd(pointcloud, d=2, threads=1):
     # Try to remove the noise from a pointcloud. (Operates in place.)
-    # First, calculate the mean Z distance from each point to its neighbors
-    z = pointcloud[:, :, 2]
-    isinf = numpy.isinf(pointcloud).any(2)
-    counts = numpy.zeros(z.shape, z.dtype)
-    zsum = numpy.zeros(z.shape, z.dtype)
-    # Horizontal distances
-    ok = ~isinf[:, :-1] & ~isinf[:, 1:]
-    zsum[:, :-1][ok] += abs(z[:, :-1][ok] - z[:, 1:][ok])
-    counts[:, :-1][ok] += 1
-    zsum[:, 1:][ok] += abs(z[:, :-1][ok] - z[:, 1:][ok])
-    counts[:, 1:][ok] += 1
-    # Vertical distances
-    ok = ~isinf[:-1, :] & ~isinf[1:, :]
-    zsum[:-1, :][ok] += abs(z[:-1, :][ok] - z[1:, :][ok])
-    counts[:-1, :][ok] += 1
-    zsum[1:, :][ok] += abs(z[:-1, :][ok] - z[1:, :][ok])
-    counts[1:, :][ok] += 1
-    isinf |= (counts == 0)
-    if isinf.all():
+    # See PcdFilter, which should be used instead to filter many pointclouds
+    # of the same size.
+    PcdFilter(pointcloud.shape[:2], pointcloud.dtype, threads).filter(pointcloud, d)
+
+
+
+class PcdFilter(object):
+
+    # Noise filter for HxWx3 pointclouds, with all of its working arrays
+    # allocated up front. Each point's mean Z distance to its (finite) horizontal
+    # and vertical neighbours is compared with the mean and standard deviation of
+    # those distances over the whole pointcloud, and the outliers are set to
+    # infinity. The sums are done with shifted views and masked ufuncs, and
+    # always add up each point's distances in the same order (right, left, down,
+    # up), so the result never depends on the number of threads.
+
+    def __init__(self, shape, dtype=numpy.float32, threads=1):
+        # shape is the (H, W) shape of the pointclouds. If threads > 1, the rows are
+        # split into that many tiles, which are processed in parallel.
+        h, w = self.shape = tuple(shape)
+        self.z = numpy.empty(shape, dtype)
+        self.zsum = numpy.empty(shape, dtype)
+        self.counts = numpy.empty(shape, dtype)
+        self.means = numpy.empty(shape, dtype)
+        self.inf = numpy.empty(shape, bool)   # Missing points
+        self.bad = numpy.empty(shape, bool)   # Points to be removed
+        self.tiles = []
+        bounds = numpy.linspace(0, h, max(1, min(threads, h)) + 1).astype(int)
+        for r0, r1 in zip(bounds[:-1], bounds[1:]):
+            # Each tile also needs the distances to the rows just outside it
+            n = min(r1 + 1, h) - max(r0 - 1, 0)
+            self.tiles.append(dict(rows=(r0, r1),
+                                   hdist=numpy.empty((r1 - r0, w - 1), dtype),
+                                   hok=numpy.empty((r1 - r0, w - 1), bool),
+                                   vdist=numpy.empty((n - 1, w), dtype),
+                                   vok=numpy.empty((n - 1, w), bool),
+                                   norm=numpy.empty((r1 - r0, w), dtype),
+                                   far=numpy.empty((r1 - r0, w), bool)))
+
+    def run(self, func, *args):
+        # Call func(tile, *args) for every tile, in parallel if there is more than one.
+        # The missing points are infinite, so the invalid operations on them are expected.
+        def call(tile):
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                func(tile, *args)
+        if len(self.tiles) == 1:
+            call(self.tiles[0])
+            return
+        errors = []
+        def worker(tile):
+            try:
+                call(tile)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(tile,)) for tile in self.tiles]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def filter(self, pointcloud, d=2):
+        # Filter a pointcloud in place. d is the number of standard deviations
+        # from the mean beyond which a point is removed. d defaults to 2, which
+        # means that on average, roughly 5% of the data points will be evicted.
+        assert pointcloud.shape == self.shape + (3,), 'Wrong pointcloud shape'
+        self.run(self.find_missing, pointcloud)
+        self.run(self.mean_distances)
+        if self.bad.all():
+            # Bogus pointcloud
+            pointcloud.fill(numpy.inf)
+            return
+        # Global mean and standard deviation of means
+        means = self.means[~self.bad]
+        mean = means.mean()
+        std = means.std()
+        self.run(self.remove, pointcloud, mean, std, d)
+
+    def find_missing(self, tile, pointcloud):
+        r0, r1 = tile['rows']
+        inf = self.inf[r0:r1]
+        bad = self.bad[r0:r1]
+        for i in range(3):
+            numpy.isinf(pointcloud[r0:r1, :, i], out=bad)
+            if i:
+                inf |= bad
+            else:
+                inf[...] = bad
+        self.z[r0:r1] = pointcloud[r0:r1, :, 2]
+
+    def mean_distances(self, tile):
+        # Calculate the mean Z distance from each point to its neighbours
+        r0, r1 = tile['rows']
+        h = self.shape[0]
+        z, inf, zsum, counts = self.z, self.inf, self.zsum, self.counts
+        zsum[r0:r1] = 0
+        counts[r0:r1] = 0
+        # Horizontal distances
+        dist, ok = tile['hdist'], tile['hok']
+        numpy.subtract(z[r0:r1, :-1], z[r0:r1, 1:], out=dist)
+        numpy.abs(dist, out=dist)
+        numpy.logical_or(inf[r0:r1, :-1], inf[r0:r1, 1:], out=ok)
+        numpy.logical_not(ok, out=ok)
+        for sl in (numpy.s_[r0:r1, :-1], numpy.s_[r0:r1, 1:]):
+            numpy.add(zsum[sl], dist, out=zsum[sl], where=ok)
+            counts[sl] += ok
+        # Vertical distances, between rows a + i and a + i + 1
+        a = max(r0 - 1, 0)
+        b = min(r1 + 1, h)
+        dist, ok = tile['vdist'], tile['vok']
+        numpy.subtract(z[a:b-1], z[a+1:b], out=dist)
+        numpy.abs(dist, out=dist)
+        numpy.logical_or(inf[a:b-1], inf[a+1:b], out=ok)
+        numpy.logical_not(ok, out=ok)
+        # First to the row below (rows r0 to r1, except the last row of the image),
+        # then to the row above (rows r0 to r1, except the first row of the image)
+        down = min(r1, h - 1)
+        up = max(r0, 1)
+        for rows, pairs in ((numpy.s_[r0:down], numpy.s_[r0-a:down-a]), (numpy.s_[up:r1], numpy.s_[up-1-a:r1-1-a])):
+            numpy.add(zsum[rows], dist[pairs], out=zsum[rows], where=ok[pairs])
+            counts[rows] += ok[pairs]
+        # Points with no neighbours at all are removed as well
+        bad = self.bad[r0:r1]
+        numpy.equal(counts[r0:r1], 0, out=bad)
+        bad |= inf[r0:r1]
+        numpy.divide(zsum[r0:r1], counts[r0:r1], out=self.means[r0:r1], where=~bad)
+
+    def remove(self, tile, pointcloud, mean, std, d):
+        # Kick out any points whose "mean" distance is not within d standard deviations
+        # of the global mean.
+        r0, r1 = tile['rows']
+        norm, far = tile['norm'], tile['far']
+        bad = self.bad[r0:r1]
+        numpy.subtract(self.means[r0:r1], mean, out=norm)
+        numpy.divide(norm, std, out=norm)
+        numpy.abs(norm, out=norm)
+        numpy.greater(norm, d, out=far)
+        bad |= far
+        numpy.copyto(pointcloud[r0:r1], numpy.inf, where=bad[..., None])
+
+
+
+# Sparse pointclouds
+# These work on an Nx3 array of points together with their (rows, cols) index,
+# which gives the pixel each point came from, as returned by numpy.nonzero().
+# The points must be in row-major order.
+
+
+def reproject_points(disparity, Q, mask, big_z=10000.0):
+    # Reproject only the pixels of a disparity map where mask is set. This gives
+    # the same points as reprojectImageTo3D(disparity, Q, handleMissingValues=True)
+    # would at those pixels, but costs nothing for the rest of the image.
+    # Returns the Nx3 float32 points and their index.
+    index = numpy.nonzero(mask)
+    rows, cols = index
+    d = disparity[index].astype(numpy.float64)
+    q = numpy.asarray(Q, numpy.float64)
+    # Q * [x, y, d, 1], rounded the same way as OpenCV: each homogeneous coordinate
+    # is summed in double precision and rounded to float32 before the division.
+    x, y, z, w = [((q[i, 0]*cols + q[i, 1]*rows) + q[i, 2]*d) + q[i, 3] for i in range(4)]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        iw = 1.0 / w
+        points = numpy.empty((len(d), 3), numpy.float32)
+        for i, coord in enumerate((x, y, z)):
+            points[:, i] = numpy.float32(coord) * iw
+    # Pixels with the minimum disparity are missing values, which are pushed far away
+    if len(d):
+        points[abs(d - disparity.min()) <= numpy.finfo(numpy.float32).eps, 2] = big_z
+    return points, index
+
+
+class ReprojectionLUT(object):
+
+    # Reprojection with the parts of Q * [x, y, d, 1] that do not depend on the
+    # disparity precomputed. For the Q made by stereoRectify(), X depends only on
+    # the column, Y only on the row and Z is a constant; the disparity only goes
+    # into W. So each point costs a table lookup and a multiply, plus the
+    # reciprocal of W. (The Gray code disparities are differences of mean pixel
+    # positions, so they are not a small set of integers that W could be
+    # tabulated over as well.)
+
+    def __init__(self, Q, shape, big_z=10000.0):
+        # shape is the (H, W) shape of the disparity maps
+        self.Q = q = numpy.array(Q, numpy.float64)
+        self.big_z = big_z
+        h, w = shape
+        # Every other coefficient has to be zero for the terms to separate.
+        zero = numpy.array([[0, 1, 1, 0], [1, 0, 1, 0], [1, 1, 1, 0], [1, 1, 0, 0]], bool)
+        self.separable = not q[zero].any()
+        if self.separable:
+            # Rounded the same way as reproject_points(), so the results are identical
+            x = numpy.arange(w, dtype=numpy.float64)
+            y = numpy.arange(h, dtype=numpy.float64)
+            self.x = numpy.float32(q[0, 0]*x + q[0, 3])
+            self.y = numpy.float32(q[1, 1]*y + q[1, 3])
+            self.z = numpy.float32(q[2, 3])
+
+    def reproject(self, disparity, mask):
+        # Same as reproject_points(disparity, Q, mask)
+        if not self.separable:
+            return reproject_points(disparity, self.Q, mask, self.big_z)
+        index = numpy.nonzero(mask)
+        rows, cols = index
+        d = disparity[index].astype(numpy.float64)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            iw = 1.0 / (self.Q[3, 2]*d + self.Q[3, 3])
+            points = numpy.empty((len(d), 3), numpy.float32)
+            numpy.multiply(self.x[cols], iw, out=points[:, 0], casting='unsafe')
+            numpy.multiply(self.y[rows], iw, out=points[:, 1], casting='unsafe')
+            numpy.multiply(self.z, iw, out=points[:, 2], casting='unsafe')
+        if len(d):
+            points[abs(d - disparity.min()) <= numpy.finfo(numpy.float32).eps, 2] = self.big_z
+        return points, index
+
+
+def take_points(points, index, keep):
+    # Return the points (and their index) where keep is set
+    return points[keep], tuple(i[keep] for i in index)
+
+
+def filter_points(points, index, d=2):
+    # Sparse version of filter_pcd(). Returns a boolean array telling which
+    # points to keep, which are exactly the ones filter_pcd() would keep if the
+    # points were scattered back into the full image.
+    n = len(points)
+    z = points[:, 2]
+    valid = ~numpy.isinf(points).any(1)
+    rows, cols = index
+    # Linear pixel index. Any row stride will do as long as there is a gap after
+    # the last column, so that no point in it finds a neighbour to its right.
+    stride = int(cols.max()) + 2 if n else 2
+    pixel = rows.astype(numpy.int64) * stride + cols
+    counts = numpy.zeros(n, z.dtype)
+    zsum = numpy.zeros(n, z.dtype)
+    # The neighbours are accumulated in the same order as filter_pcd(), so the
+    # floating point sums come out exactly the same.
+    for offset in (1, stride):
+        # Find the neighbour to the right (offset 1) or below (offset stride)
+        other = numpy.searchsorted(pixel, pixel + offset)
+        found = other < n
+        found[found] = pixel[other[found]] == pixel[found] + offset
+        first = numpy.nonzero(found)[0]
+        second = other[first]
+        ok = valid[first] & valid[second]
+        first = first[ok]
+        second = second[ok]
+        dist = abs(z[first] - z[second])
+        zsum[first] += dist
+        counts[first] += 1
+        zsum[second] += dist
+        counts[second] += 1
+    keep = valid & (counts != 0)
+    if not keep.any():
         # Bogus pointcloud
-        pointcloud.fill(numpy.inf)
-        return
+        return keep
     # Mean distances
-    means = numpy.empty(z.shape, z.dtype)
-    means[~isinf] = zsum[~isinf] / counts[~isinf]
+    means = numpy.empty(n, z.dtype)
+    means[keep] = zsum[keep] / counts[keep]
     # Global mean and standard deviation of means
-    mean = means[~isinf].mean()
-    std = means[~isinf].std()
+    mean = means[keep].mean()
+    std = means[keep].std()
     norm = (means - mean) / std
     # Kick out any points whose "mean" distance is not within d standard deviations
-    # of the global mean. d defaults to 2, which means that on average, roughly 5%
-    # of the data points will be evicted.
-    isinf |= (abs(norm) > d)
-    pointcloud[isinf] = numpy.inf
+    # of the global mean.
+    keep &= ~(abs(norm) > d)
+    return keep
+
+
+
+
+
+# Voxel grid
+# These work on pointclouds of any shape (HxWx3 or Nx3). The points are
+# hashed into a grid of cubic voxels, so that every point only has to be
+# compared with the points in the voxels around it. Points that are not
+# finite are ignored.
+
+PAIR_CHUNK = 1 << 20 # Maximum number of point pairs compared at once by radius_inliers()
 
 
+def finite_points(pointcloud):
+    # Return the finite points of a pointcloud as an Nx3 array
+    points = pointcloud.reshape(-1, 3)
+    return points[numpy.isfinite(points).all(1)]
+
+
+def voxel_keys(points, size):
+    # Return the voxel of each point of an Nx3 array as a single integer key,
+    # together with the key offset between neighbouring voxels along each axis.
+    # There is an empty layer of voxels on each side, so the keys of the
+    # neighbouring voxels are never those of voxels on the other side of the grid.
+    cell = numpy.floor((points - points.min(0)) / size).astype(numpy.int64) + 1
+    dims = cell.max(0) + 2
+    strides = numpy.array([dims[1] * dims[2], dims[2], 1])
+    return numpy.dot(cell, strides), strides
+
+
+def radius_inliers(pointcloud, radius, min_neighbors):
+    # Radius outlier removal. Returns a boolean array (of the shape of the
+    # pointcloud without its last axis) telling which points have at least
+    # min_neighbors other points within radius of them.
+    keep = numpy.zeros(pointcloud.shape[:-1], bool)
+    finite = numpy.isfinite(pointcloud).all(-1)
+    points = pointcloud[finite].astype(numpy.float64)
+    n = len(points)
+    if n == 0:
+        return keep
+    # With voxels the size of the radius, every neighbour is in one of the
+    # 27 voxels around the point.
+    keys, strides = voxel_keys(points, radius)
+    order = numpy.argsort(keys, kind='stable')
+    keys = keys[order]
+    points = points[order]
+    counts = numpy.zeros(n, numpy.int64)
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                # The range of (sorted) points in the neighbouring voxel of each point
+                other = keys + (dx*strides[0] + dy*strides[1] + dz*strides[2])
+                start = numpy.searchsorted(keys, other, 'left')
+                m = numpy.searchsorted(keys, other, 'right') - start
+                # Compare every (point, candidate) pair, a chunk of points at a time
+                ends = numpy.cumsum(m)
+                a = 0
+                while a < n:
+                    base = ends[a-1] if a else 0
+                    b = max(int(numpy.searchsorted(ends, base + PAIR_CHUNK, 'right')), a + 1)
+                    i = numpy.repeat(numpy.arange(a, b), m[a:b])
+                    j = numpy.arange(base, ends[b-1]) + numpy.repeat(start[a:b] - (ends[a:b] - m[a:b]), m[a:b])
+                    close = ((points[i] - points[j]) ** 2).sum(1) <= radius * radius
+                    counts += numpy.bincount(i[close], minlength=n)
+                    a = b
+    # Every point has found itself once
+    inliers = numpy.empty(n, bool)
+    inliers[order] = counts - 1 >= min_neighbors
+    keep[finite] = inliers
+    return keep
+
+
+def voxel_downsample(pointcloud, size):
+    # Downsample a pointcloud to the mean of the points in each voxel of the
+    # given size. Returns an Nx3 float32 array.
+    points = finite_points(pointcloud).astype(numpy.float64)
+    if len(points) == 0:
+        return numpy.empty((0, 3), numpy.float32)
+    keys, strides = voxel_keys(points, size)
+    keys, inverse = numpy.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+    counts = numpy.bincount(inverse)
+    result = numpy.empty((len(keys), 3), numpy.float32)
+    for i in range(3):
+        result[:, i] = numpy.bincount(inverse, points[:, i]) / counts
+    return result
+
+
+def downsample_to(pointcloud, max_points, steps=16):
+    # Downsample a pointcloud to at most max_points points, with voxels as small
+    # as possible. The voxel size is found by bisection in the given number of steps.
+    points = finite_points(pointcloud)
+    if len(points) <= max_points:
+        return numpy.float32(points)
+    assert max_points > 0, 'Cannot downsample to no points'
+    points = points.astype(numpy.float64)
+    low = 0.0
+    high = (points.max(0) - points.min(0)).max() * 1.01 + 1e-6 # One voxel holds everything
+    for i in range(steps):
+        size = 0.5 * (low + high)
+        if len(numpy.unique(voxel_keys(points, size)[0])) <= max_points:
+            high = size
+        else:
+            low = size
+    return voxel_downsample(points, high)
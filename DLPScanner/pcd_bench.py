@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+# Benchmark for the .pcd file formats
+# ECEN 404
+
+# Times saving and loading the pointclouds in pcd_files/ and stereo_captures/
+# in each format supported by save_pcd(), and compares the file sizes. The
+# binary_compressed format is also timed without python-lzf, if it is installed,
+# and the ascii format against the original one point at a time writer.
+
+import os
+import tempfile
+import DLPScanner.pcd as pcd
+from DLPScanner.pcd import *
+from DLPScanner.bench import *
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CLOUDS = [os.path.join(ROOT, 'pcd_files', 'Zaghetto.pcd'), os.path.join(ROOT, 'stereo_captures', 'pointcloud.npy')]
+REPEAT = 5
+
+Bench.on = True
+
+
+def original_save_ascii(points, filename):
+    # The ASCII data as save_pcd() originally wrote it
+    with open(filename, 'wb') as o:
+        for point in points:
+            o.write(b'%g %g %g\n' % tuple(point))
+
+
+def ascii_data(filename):
+    with open(filename, 'rb') as o:
+        return o.read().split(b'DATA ascii\n', 1)[1]
+
+
+formats = [('ascii', dict(binary=False)), ('binary', dict()), ('binary_compressed', dict(compressed=True))]
+lzf_module = pcd.lzf
+filename = os.path.join(tempfile.mkdtemp(), 'bench.pcd')
+
+for path in CLOUDS:
+    cloud = numpy.load(path) if path.endswith('.npy') else load_pcd(path)
+    points = cloud.reshape(-1, 3)
+    points = points[~numpy.isinf(points).any(1)]
+    print('%s (%d points):' % (os.path.basename(path), len(points)))
+    for name, kwargs in formats:
+        for module in ((lzf_module, None) if (kwargs.get('compressed') and lzf_module) else (lzf_module,)):
+            pcd.lzf = module
+            label = name if module is lzf_module else name + ' (pure Python)'
+            repeat = REPEAT if module else 1
+            with Bench('  Save %s (x%d)' % (label, repeat)):
+                for i in range(repeat):
+                    save_pcd(cloud, filename, **kwargs)
+            with Bench('  Load %s (x%d)' % (label, repeat)):
+                for i in range(repeat):
+                    loaded = load_pcd(filename)
+            print('  %s: %d bytes' % (label, os.path.getsize(filename)))
+            if name == 'ascii':
+                assert numpy.allclose(loaded, points, rtol=1e-5), 'ascii file does not match'
+                with Bench('  Save ascii, one point at a time (x%d)' % repeat):
+                    for i in range(repeat):
+                        original_save_ascii(points, filename + '.orig')
+                assert ascii_data(filename) == open(filename + '.orig', 'rb').read(), 'ascii data is not the same'
+                os.remove(filename + '.orig')
+            else:
+                assert numpy.array_equal(loaded, points), '%s file does not match' % name
+pcd.lzf = lzf_module
+os.remove(filename)
@@ -15,20 +15,67 @@ class PiCamera(object):
     def __init__(self):
         self.cam = picamera.PiCamera()
         self.do_flip = False
+        self.luma = False
+        self.buffer = None
 
     def close(self):
         self.cam.close()
 
-    def capture(self):
-        raw = picamera.array.PiRGBArray(self.cam)
-        self.cam.capture(raw, format='bgr', use_video_port=True)
-        return raw.array[::-1, ::-1] if self.do_flip else raw.array
+    def capture(self, after=None):
+        # after is accepted for compatibility with CVCamera.capture(). The video
+        # port always returns a frame that began exposing after this call.
+        if self.luma:
+            # Capture YUV straight into the preallocated buffer, and return a view
+            # of its Y plane. This is only valid until the next capture.
+            self.cam.capture(self.buffer, format='yuv', use_video_port=True)
+            im = self.y
+        else:
+            raw = picamera.array.PiRGBArray(self.cam)
+            self.cam.capture(raw, format='bgr', use_video_port=True)
+            im = raw.array
+        return im[::-1, ::-1] if self.do_flip else im
+
+    def capture_sequence(self, n, on_frame):
+        # Capture n frames in a row with the camera kept in continuous (video
+        # port) mode, calling on_frame(i, frame) after each one. The next frame is
+        # not captured until on_frame() returns. In luma mode, each frame is only
+        # valid until on_frame() returns.
+        def outputs():
+            for i in range(n):
+                if self.luma:
+                    yield self.buffer
+                    im = self.y
+                else:
+                    raw = picamera.array.PiRGBArray(self.cam)
+                    yield raw
+                    im = raw.array
+                on_frame(i, im[::-1, ::-1] if self.do_flip else im)
+        self.cam.capture_sequence(outputs(), format='yuv' if self.luma else 'bgr', use_video_port=True)
 
     def set_resolution(self, w, h):
         self.cam.resolution = (w, h)
+        self.alloc_buffer()
 
     def set_brightness(self, val):
         self.cam.brightness = val
 
+    def set_luma(self, luma=True):
+        # In luma mode, capture() returns a grayscale image rather than BGR.
+        self.luma = bool(luma)
+        self.alloc_buffer()
+
+    def alloc_buffer(self):
+        # Allocate the buffer used by luma captures. YUV captures are padded to
+        # a multiple of 32 columns and 16 rows, followed by the quarter size U
+        # and V planes.
+        if self.luma:
+            w, h = self.cam.resolution
+            fw = (w + 31) // 32 * 32
+            fh = (h + 15) // 16 * 16
+            self.buffer = numpy.empty(fw * fh * 3 // 2, numpy.uint8)
+            self.y = self.buffer[:fw*fh].reshape((fh, fw))[:h, :w]
+        else:
+            self.buffer = None
+
     def flip(self, do_flip=True):
         self.do_flip = bool(do_flip)
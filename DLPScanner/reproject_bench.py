@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+# Benchmark for the reprojection used by OpenCV.snapshot()
+# ECEN 404
+
+# Compares reprojectImageTo3D() over the whole disparity map, against
+# reproject_points() and the ReprojectionLUT over just the valid pixels, and
+# over every pixel. The disparity map in stereo_captures/ is used as input.
+
+import os
+from DLPScanner.cvstereo import *
+
+CAPTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stereo_captures')
+REPEAT = 100
+
+Bench.on = True
+
+
+cv = OpenCV()
+cv.rectify(K1, D1, K2, D2, R, T)
+disparityMap = numpy.float32(numpy.load(os.path.join(CAPTURE_DIR, 'disparity.npy')))
+scaledDisparityMap = convertScaleAbs(disparityMap, alpha=255.0 / (disparityMap.max() - disparityMap.min()))
+retval, thresh = threshold(scaledDisparityMap, 0, 255, THRESH_OTSU | THRESH_BINARY)
+lut = ReprojectionLUT(cv.Q, disparityMap.shape)
+assert lut.separable, 'Q cannot be split into lookup tables'
+
+with Bench('Table setup (x%d)' % REPEAT):
+    for i in range(REPEAT):
+        ReprojectionLUT(cv.Q, disparityMap.shape)
+with Bench('reprojectImageTo3D, whole map (x%d)' % REPEAT):
+    for i in range(REPEAT):
+        dense = reprojectImageTo3D(disparityMap, cv.Q, handleMissingValues=True)
+
+for name, mask in (('valid pixels', thresh != 0), ('every pixel', numpy.ones(disparityMap.shape, bool))):
+    print('%d points (%s):' % (numpy.count_nonzero(mask), name))
+    with Bench('  reproject_points (x%d)' % REPEAT):
+        for i in range(REPEAT):
+            points1, index1 = reproject_points(disparityMap, cv.Q, mask)
+    with Bench('  ReprojectionLUT (x%d)' % REPEAT):
+        for i in range(REPEAT):
+            points2, index2 = lut.reproject(disparityMap, mask)
+    assert numpy.array_equal(points1, points2, equal_nan=True), 'ReprojectionLUT gives different points'
+    assert numpy.array_equal(dense[index2], points2, equal_nan=True), 'reprojectImageTo3D gives different points'
+print('All reprojections give the same points.')
@@ -0,0 +1,46 @@
+# Preallocated image stack
+# ECEN 404
+
+# Used by cvstereo.py to hold the captured and rectified frames of a scan.
+# Behaves like a list of frames, but the frames live in one contiguous
+# (N, H, W) uint8 array which is allocated once and reused for every scan.
+
+import numpy
+
+
+
+class FrameStack(object):
+
+    def __init__(self, n, shape, dtype=numpy.uint8):
+        # n is the expected number of frames, shape is the (H, W) shape of each frame
+        self.array = numpy.empty((n,) + tuple(shape), dtype)
+        self.n = 0
+
+    def clear(self):
+        self.n = 0
+
+    def next(self):
+        # Return the next free frame of the stack, to be written into in place.
+        # If the stack is full it is grown, which only happens if more frames are
+        # captured than were planned for (e.g. during calibration).
+        if self.n == len(self.array):
+            self.array = numpy.concatenate((self.array, numpy.empty_like(self.array[:max(self.n, 1)])))
+        frame = self.array[self.n]
+        self.n += 1
+        return frame
+
+    def append(self, frame):
+        self.next()[...] = frame
+
+    def view(self):
+        # The filled part of the stack, as an (n, H, W) array (not a copy)
+        return self.array[:self.n]
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return self.view()[i]
+
+    def __iter__(self):
+        return iter(self.view())
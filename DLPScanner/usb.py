@@ -2,13 +2,67 @@
 # Matthew Kroesche
 # ECEN 403-404
 
+import ctypes
+import ctypes.util
 import os
+import select
+import struct
+import threading
+import time
 from .pcd import *
 
 
 # USB locations
 USB_PATH = '/media/pi'
 
+USB_POLL = 1.0 # Time (in seconds) between checks of USB_PATH when it cannot be watched with inotify
+
+
+# inotify is used to find out when a drive is mounted or unmounted, without
+# having to list USB_PATH over and over again. It is only available on Linux;
+# everywhere else, the watcher falls back on polling.
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.inotify_init1
+except (OSError, AttributeError):
+    libc = None
+
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_IGNORED = 0x8000 # The watched directory itself is gone
+
+
+def inotify_watch(path):
+    # Return a file descriptor that becomes readable whenever an entry is added
+    # to or removed from the directory path, or None if this is not possible.
+    if libc is None:
+        return None
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        return None
+    mask = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def inotify_read(fd):
+    # Read the pending events from fd. Returns False if the watch has been removed.
+    try:
+        data = os.read(fd, 4096)
+    except BlockingIOError:
+        return True
+    i = 0
+    while i + 16 <= len(data):
+        wd, mask, cookie, length = struct.unpack_from('iIII', data, i)
+        if mask & IN_IGNORED:
+            return False
+        i += 16 + length
+    return True
+
 
 
 
@@ -17,17 +71,75 @@ class USB(object):
     def __init__(self, master):
         self.master = master
         self.n = 1
+        self.watcher = None
+        self.mounted = False
 
-    # init(), quit() are just for modularity.
-    # They don't do anything.
+    # init() is just for modularity.
+    # It doesn't do anything.
     def init(self): pass
-    def quit(self): pass
+
+    def quit(self):
+        self.unwatch()
 
     def connected(self):
-        # Return True if the USB drive exists.
-        return bool(os.listdir(USB_PATH))
+        # Return True if the USB drive exists. While the watcher is running,
+        # this is the last state it saw.
+        if self.watcher:
+            return self.mounted
+        return self.check()
+
+    def check(self):
+        try:
+            return bool(os.listdir(USB_PATH))
+        except OSError:
+            return False
+
+
+
+    # Mount watcher
+
+    def watch(self, callback):
+        # Start a thread that calls callback(connected) whenever a USB drive is
+        # mounted or unmounted, and once at the start with the current state.
+        if self.watcher is None:
+            self.watching = True
+            self.watcher = threading.Thread(target=self.watch_loop, args=(callback,), daemon=True)
+            self.watcher.start()
+
+    def unwatch(self):
+        if self.watcher is not None:
+            self.watching = False
+            self.watcher.join()
+            self.watcher = None
+
+    def watch_loop(self, callback):
+        fd = None
+        last = None
+        try:
+            while self.watching:
+                if fd is None:
+                    # Set up the watch before checking, so nothing is missed in between.
+                    # If USB_PATH does not exist yet, this is retried every USB_POLL.
+                    fd = inotify_watch(USB_PATH)
+                self.mounted = self.check()
+                if self.mounted != last:
+                    last = self.mounted
+                    callback(last)
+                # Wait for a change, waking up every USB_POLL to see if we should stop
+                if fd is None:
+                    time.sleep(USB_POLL)
+                elif select.select([fd], [], [], USB_POLL)[0] and not inotify_read(fd):
+                    os.close(fd)
+                    fd = None
+        finally:
+            if fd is not None:
+                os.close(fd)
 
     def send(self, pointcloud):
+        self.write(encode_pcd(pointcloud, compressed=SEND_COMPRESSED))
+
+    def write(self, data):
+        # Save the contents of a .pcd file to the USB drive
         # Locate the USB drive
         dir = os.listdir(USB_PATH)
         if not dir:
@@ -42,7 +154,8 @@ class USB(object):
         else:
             return
         # Save the pointcloud to the file
-        save_pcd(pointcloud, filename)
+        with open(filename, 'wb') as o:
+            o.write(data)
 
     def eject(self):
         # Eject the USB device
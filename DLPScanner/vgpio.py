@@ -4,6 +4,7 @@
 
 from tkinter import *
 import cv2
+import threading
 
 # Channel constants
 EJECT_BUTTON = 17
@@ -46,23 +47,33 @@ class LED(Frame):
 
 class VGPIO(object):
 
-    def __init__(self):
+    def __init__(self, headless=False):
+        # If headless is set, no window is shown: buttons are pressed by calling
+        # press(), and the state of the LEDs can be read from .outputs.
+        self.headless = headless
         self.root = None
         self.inputs = set()
+        self.outputs = {} # Current state of each output channel
+        self.shown = {}   # State of each output channel as last shown onscreen
+        self.callbacks = {} # Edge callbacks, by input channel
+        self.projector = False # Whether the projector window was last made fullscreen
+        self.window_lock = None # Lock held while a scan is using the projector (set by IO)
 
 
 
     def setmode(self, *args):
         if self.root:
             self.cleanup()
+        if self.headless:
+            return
         self.root = Tk()
         self.root.withdraw()
         self.root.title('Virtual I/O')
         self.root.minsize(300, 0)
         self.root.attributes('-topmost', True)
-        self.eject_button = Button(self.root, text='Eject USB', command = lambda: self.inputs.add(EJECT_BUTTON))
+        self.eject_button = Button(self.root, text='Eject USB', command = lambda: self.press(EJECT_BUTTON))
         self.eject_button.pack(side=TOP, fill=X, padx=10, pady=10)
-        self.snapshot_button = Button(self.root, text='Snapshot', command = lambda: self.inputs.add(SNAPSHOT_BUTTON))
+        self.snapshot_button = Button(self.root, text='Snapshot', command = lambda: self.press(SNAPSHOT_BUTTON))
         self.snapshot_button.pack(side=TOP, fill=X, padx=10, pady=10)
         self.power_led = LED(self, POWER_LED, 'Power', '#070', '#0f0')
         self.power_led.pack(side=TOP, fill=X, padx=10, pady=10)
@@ -83,6 +94,9 @@ class VGPIO(object):
             self.root.destroy()
             self.root = None
         self.inputs.clear()
+        self.outputs.clear()
+        self.shown.clear()
+        self.callbacks.clear()
 
 
     # Compatibility
@@ -91,21 +105,12 @@ class VGPIO(object):
 
 
     def output(self, id, status):
-        if id == BUSY_LED:
-            # Show or hide the projector depending on whether the device is busy
-            try:
-                cv2.setWindowProperty('projector', cv2.WND_PROP_FULLSCREEN, int(bool(status)))
-                cv2.waitKey(1)
-            except cv2.error:
-                pass
-        for led in (self.power_led, self.wifi_led, self.usb_led, self.busy_led, self.error_led):
-            if led.id == id:
-                if status:
-                    led.activate()
-                else:
-                    led.deactivate()
-                break
-        self.update()
+        # Outputs may be set from any thread, but Tk may only be used from the
+        # main one, so from other threads the window is brought up to date by
+        # the next call to update().
+        self.outputs[id] = bool(status)
+        if threading.current_thread() is threading.main_thread():
+            self.update()
 
 
     def input(self, id):
@@ -115,12 +120,65 @@ class VGPIO(object):
         return False
 
 
+    def add_event_detect(self, id, edge, callback=None, bouncetime=None):
+        # Same as RPi.GPIO.add_event_detect(). Pressing a button is a rising edge
+        # followed by a falling edge; bouncetime is ignored.
+        self.callbacks[id] = (edge, callback)
+
+    def remove_event_detect(self, id):
+        self.callbacks.pop(id, None)
+
+
+    def press(self, id):
+        # Press and release the button on channel id, calling its edge callback.
+        self.inputs.add(id)
+        if id in self.callbacks:
+            edge, callback = self.callbacks[id]
+            if callback is not None:
+                callback(id)
+
+
     def update(self):
-        self.root.update()
+        # Show any changed outputs onscreen, and process events from the window.
+        # This is called regularly by the main loop.
+        for id, status in list(self.outputs.items()):
+            if id == BUSY_LED and not self.headless and self.projector != status and self.show_projector(status):
+                self.projector = status
+            if self.shown.get(id) == status:
+                continue
+            self.shown[id] = status
+            if self.root:
+                for led in (self.power_led, self.wifi_led, self.usb_led, self.busy_led, self.error_led):
+                    if led.id == id:
+                        if status:
+                            led.activate()
+                        else:
+                            led.deactivate()
+                        break
+        if self.root:
+            self.root.update()
+
+
+    def show_projector(self, status):
+        # Show or hide the projector depending on whether the device is busy.
+        # This is skipped (and returns False, to be tried again by the next
+        # update()) while a scan is using the projector; the scan shows it itself.
+        if self.window_lock is not None and not self.window_lock.acquire(False):
+            return False
+        try:
+            cv2.setWindowProperty('projector', cv2.WND_PROP_FULLSCREEN, int(status))
+            cv2.waitKey(1)
+        except cv2.error:
+            pass
+        finally:
+            if self.window_lock is not None:
+                self.window_lock.release()
+        return True
 
 
     # Constants
     BCM = IN = OUT = PUD_DOWN = None # Compatibility
+    RISING = FALLING = BOTH = None   # Compatibility
     HIGH = True
     LOW = False
         
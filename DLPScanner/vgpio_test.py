@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# Headless virtual I/O test
+# ECEN 404
+
+# Runs the I/O event loop against a headless VGPIO, with stand-ins for the
+# cameras, exporter, USB and WiFi, pressing the buttons with VGPIO.press() and
+# checking the LEDs from VGPIO.outputs. (Like the rest of gpio.py, this needs
+# RPi.GPIO to be importable, unless IS_VIRTUAL is set.)
+
+import threading
+import time
+
+from DLPScanner import gpio
+from DLPScanner.gpio import *
+from DLPScanner.vgpio import VGPIO
+
+TIMEOUT = 5 # Time (in seconds) to wait for each expected change
+
+
+
+class Scanner(object):
+    # Stand-in for the OpenCV object; each snapshot waits until it is released
+    has_preview = False
+    def __init__(self):
+        self.scans = 0
+        self.release = threading.Event()
+    def snapshot(self):
+        self.release.wait()
+        self.scans += 1
+        return 'pointcloud %d' % self.scans
+
+class Exporter(object):
+    def __init__(self):
+        self.exported = []
+    def export(self, data):
+        self.exported.append(data)
+
+class Link(object):
+    # Stand-in for the USB and WiFi objects
+    def __init__(self):
+        self.on = False
+        self.ejected = 0
+        self.callback = None
+    def connected(self):
+        return self.on
+    def watch(self, callback):
+        self.callback = callback
+    def set(self, on):
+        self.on = on
+        self.callback(on)
+    def eject(self):
+        self.ejected += 1
+        self.on = False
+
+class Master(object):
+    def __init__(self):
+        self.opencv = Scanner()
+        self.exporter = Exporter()
+        self.usb = Link()
+        self.wifi = Link()
+        self.io = IO(self)
+
+
+
+def led(id):
+    # State of an output channel (VGPIO.setup() ignores the initial state)
+    return GPIO.outputs.get(id, False)
+
+def wait_for(test, what):
+    deadline = time.time() + TIMEOUT
+    while not test():
+        assert time.time() < deadline, 'Timed out waiting for ' + what
+        time.sleep(.01)
+    print('OK: ' + what)
+
+
+
+gpio.GPIO = GPIO = VGPIO(headless=True)
+master = Master()
+io = master.io
+io.is_virtual = True
+io.init()
+threading.Thread(target=io.run, daemon=True).start()
+wait_for(lambda: master.usb.callback and master.wifi.callback, 'event loop started')
+assert led(POWER_LED), 'Power LED is off'
+
+# LEDs follow the USB and WiFi connections
+master.usb.set(True)
+wait_for(lambda: led(USB_LED), 'USB LED on')
+master.wifi.set(True)
+wait_for(lambda: led(WIFI_LED), 'WiFi LED on')
+master.wifi.set(False)
+wait_for(lambda: not led(WIFI_LED), 'WiFi LED off')
+
+# The snapshot button starts a scan, lighting the busy LED until it is exported
+GPIO.press(SNAPSHOT_BUTTON)
+wait_for(lambda: led(BUSY_LED), 'busy LED on during scan')
+master.opencv.release.set()
+wait_for(lambda: master.exporter.exported == ['pointcloud 1'], 'scan exported')
+wait_for(lambda: not led(BUSY_LED), 'busy LED off after scan')
+assert not led(ERROR_LED), 'Error LED is on'
+
+# A failed scan lights the error LED, and the next scan clears it
+master.opencv.snapshot = lambda: None
+GPIO.press(SNAPSHOT_BUTTON)
+wait_for(lambda: led(ERROR_LED), 'error LED on after failed scan')
+del master.opencv.snapshot
+GPIO.press(SNAPSHOT_BUTTON)
+wait_for(lambda: master.exporter.exported[-1] == 'pointcloud 2', 'second scan exported')
+wait_for(lambda: not led(ERROR_LED), 'error LED off after scan')
+
+# The eject button ejects the USB drive when there is one
+GPIO.press(EJECT_BUTTON)
+wait_for(lambda: master.usb.ejected == 1, 'USB drive ejected')
+master.usb.callback(False)
+wait_for(lambda: not led(USB_LED), 'USB LED off')
+
+io.quit()
+print('All tests passed')
@@ -2,58 +2,455 @@
 # Matthew Kroesche
 # ECEN 403-404
 
+import asyncio
+import base64
+import hashlib
+import json
 import os
+import re
+import selectors
+import socket
+import struct
 import subprocess
+import sys
 import threading
-import queue
+import time
 from .pcd import *
 
 
 SOCKETS_DIR = '/home/pi/Desktop/DLPScanner/socketsfile'
 
+BUILTIN_SERVER = False # If set, the remote application is served by ScanServer instead of the node server
+SERVER_PORT = 3000     # Port the remote application is served on by ScanServer
+
+MAX_LINE = 4096 # Maximum length of a line of server output that is kept; the rest is dropped
+
+
+# Upload states, parsed from the server output
+UPLOAD_IDLE = 'idle'           # Nothing has been uploaded yet
+UPLOAD_RUNNING = 'uploading'   # An upload has started; see .progress
+UPLOAD_COMPLETE = 'complete'   # The last upload finished
+UPLOAD_FAILED = 'failed'       # The last upload failed or was aborted
+
+PROGRESS_LINE = re.compile(br'(\d+) / (\d+) byte\(s\)$')
+
+
+# Files served by ScanServer, relative to SOCKETS_DIR (the same ones as server.js)
+STATIC_FILES = {
+    '/': 'client/index.html',
+    '/buttons.js': 'client/buttons.js',
+    '/setstage.js': 'client/setstage.js',
+    '/socket.io.js': 'node_modules/socket.io-client/dist/socket.io.js',
+    '/socket.io-file-client.js': 'node_modules/socket.io-file-client/socket.io-file-client.js',
+    '/three.js': 'node_modules/three/build/three.js',
+    '/TrackballControls.js': 'node_modules/three/examples/js/controls/TrackballControls.js',
+    '/OrbitControls.js': 'node_modules/three/examples/js/controls/OrbitControls.js',
+    '/WebGL.js': 'node_modules/three/examples/js/WebGL.js',
+    '/stats.min.js': 'node_modules/three/examples/js/libs/stats.min.js',
+    '/PCDLoader.js': 'node_modules/three/examples/js/loaders/PCDLoader.js',
+}
+SCAN_PATH = '/upload.pcd' # The latest scan, served from memory
+SCANS_SOCKET = '/scans'   # WebSocket that announces every new scan
+
+CONTENT_TYPES = {'.html': 'text/html; charset=utf-8', '.js': 'application/javascript', '.pcd': 'application/octet-stream'}
+
+MAX_REQUEST = 16384 # Maximum size of the headers of a request, and of a WebSocket message
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11' # Used in the WebSocket handshake
+
 
 class WiFi(object):
 
     def __init__(self, master):
         self.master = master
         self.popen = None
+        self.thread = None
+        self.server = None
+        self.callback = None
+        # The state below is only ever written by a single thread (the reader, or
+        # the scan server), and each attribute is replaced as a whole, so it can
+        # be read from any thread without locking.
         self.read_connected = False
-        self.queue = queue.Queue()
-        self.pmutex = threading.Lock()
+        self.upload = UPLOAD_IDLE
+        self.progress = (0, 0) # Bytes written and total size of the current upload
+        self.uploads = 0 # Number of uploads completed
 
     def init(self):
+        if BUILTIN_SERVER:
+            # A client connecting to the scan server counts as a connection
+            self.server = ScanServer(on_connect=self.set_connected)
+            self.server.start()
+            return
         cd = os.getcwd()
         os.chdir(SOCKETS_DIR)
         self.popen = subprocess.Popen(('node', 'server'), stdout=subprocess.PIPE)
-        self.thread = threading.Thread(target=self.read_loop)
-        self.thread.start()
         os.chdir(cd)
+        # The reader sleeps in a selector on the server output and the read end
+        # of a pipe, so that quit() can wake it up at any time.
+        self.wake_r, self.wake_w = os.pipe()
+        self.thread = threading.Thread(target=self.read_loop, args=(self.popen.stdout.fileno(),), daemon=True)
+        self.thread.start()
 
     def quit(self):
-        with self.pmutex:
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+        if self.thread is not None:
+            os.write(self.wake_w, b'\0')
+            self.thread.join()
+            self.thread = None
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+        if self.popen is not None:
             self.popen.kill()
+            self.popen.wait()
             self.popen = None
 
-    def read_loop(self):
-        while True:
-            with self.pmutex:
-                if self.popen is None:
-                    break
-                self.queue.put(self.popen.stdout.readline())
+    def watch(self, callback):
+        # Call callback(connected) from a background thread whenever the connection
+        # state changes, and once now with the current state.
+        self.callback = callback
+        callback(self.read_connected)
 
-    def connected(self):
-        if self.read_connected:
-            return True
+
+
+    # Server output reader
+
+    def read_loop(self, fd):
+        os.set_blocking(fd, False)
+        selector = selectors.DefaultSelector()
+        selector.register(fd, selectors.EVENT_READ)
+        selector.register(self.wake_r, selectors.EVENT_READ)
+        line = b''
         try:
-            if self.queue.get_nowait().strip() == b'Socket connected.':
-                self.read_connected = True
-                return True
-        except queue.Empty:
-            return False
-        return False
+            while True:
+                for key, events in selector.select():
+                    if key.fd == self.wake_r:
+                        return
+                    try:
+                        data = os.read(fd, 65536)
+                    except BlockingIOError:
+                        continue
+                    if not data:
+                        return # The server has exited
+                    lines = (line + data).split(b'\n')
+                    for l in lines[:-1]:
+                        self.parse(l[:MAX_LINE].strip())
+                    line = lines[-1][:MAX_LINE]
+        finally:
+            selector.close()
+
+    def parse(self, line):
+        # Advance the state machine by one line of server output
+        if line == b'Socket connected.':
+            self.set_connected()
+        elif line == b'Start uploading':
+            self.progress = (0, 0)
+            self.upload = UPLOAD_RUNNING
+        elif line == b'Upload Complete.':
+            self.uploads += 1
+            self.upload = UPLOAD_COMPLETE
+        elif line.startswith(b'Error!') or line.startswith(b'Aborted:'):
+            self.upload = UPLOAD_FAILED
+        else:
+            m = PROGRESS_LINE.match(line)
+            if m:
+                self.progress = (int(m.group(1)), int(m.group(2)))
+
+
+
+    def set_connected(self):
+        if not self.read_connected:
+            self.read_connected = True
+            if self.callback:
+                self.callback(True)
+
+    def connected(self):
+        return self.read_connected
 
     def send(self, pointcloud):
+        self.write(encode_pcd(pointcloud, compressed=SEND_COMPRESSED))
+
+    def write(self, data):
+        # Save the contents of a .pcd file where the remote application can download it
+        if self.server is not None:
+            self.server.publish(data)
+            return
         filename = os.path.join(SOCKETS_DIR, 'data', 'upload.pcd')
-        save_pcd(pointcloud, filename)
-            
-        
+        with open(filename, 'wb') as o:
+            o.write(data)
+
+
+
+
+# In-process server for the remote application, used in place of the node
+# server when BUILTIN_SERVER is set. It serves the same static files, but the
+# latest scan is kept in memory instead of being written to data/upload.pcd and
+# read back, and every new scan is announced to the clients over a WebSocket.
+# It runs an asyncio event loop on a thread of its own.
+
+class ScanServer(object):
+
+    def __init__(self, root=SOCKETS_DIR, port=SERVER_PORT, on_connect=None):
+        # root is the folder holding client/ and node_modules/. With port = 0, a
+        # free port is chosen, which can be read from .port after start().
+        # on_connect() is called from the server thread on every request.
+        self.root = root
+        self.port = port
+        self.on_connect = on_connect
+        self.scan = None # (data, etag) of the latest scan, replaced as a whole
+        self.count = 0
+        self.started = int(time.time()) # Keeps the ETags unique across restarts
+        self.connections = set() # Writers of every open connection
+        self.sockets = set() # Writers of the connected WebSockets
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(ready,), daemon=True)
+        self.thread.start()
+        ready.wait()
+        assert self.server is not None, 'Could not start scan server'
+
+    def stop(self):
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+
+    def run(self, ready):
+        self.loop = asyncio.new_event_loop()
+        try:
+            # Listen on a single socket, accepting both IPv4 and IPv6 where the
+            # system allows it, so that a port chosen with port = 0 is the same
+            # for both.
+            if socket.has_dualstack_ipv6():
+                sock = socket.create_server(('', self.port), family=socket.AF_INET6, dualstack_ipv6=True)
+            else:
+                sock = socket.create_server(('', self.port))
+            self.port = sock.getsockname()[1]
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, sock=sock, limit=MAX_REQUEST))
+        except OSError as e:
+            print('Error starting scan server: %r' % e)
+        ready.set()
+        if self.server is None:
+            self.loop.close()
+            return
+        try:
+            self.loop.run_forever()
+        finally:
+            # Drop every open connection, and let the handlers finish
+            self.server.close()
+            for writer in self.connections:
+                writer.close()
+            tasks = asyncio.all_tasks(self.loop)
+            if tasks:
+                self.loop.run_until_complete(asyncio.wait(tasks))
+            self.loop.close()
+
+    def publish(self, data):
+        # Make data (the contents of a .pcd file) the latest scan. This may be
+        # called from any thread.
+        self.count += 1
+        scan = (bytes(data), '"%x-%d"' % (self.started, self.count))
+        self.scan = scan
+        self.loop.call_soon_threadsafe(self.announce, scan)
+
+
+
+    # HTTP
+
+    async def handle(self, reader, writer):
+        # Serve the requests of one connection, until it is closed
+        self.connections.add(writer)
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, path, version = lines[0].split()
+                except ValueError:
+                    return
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                path = path.split('?', 1)[0]
+                if self.on_connect:
+                    self.on_connect()
+                if path == SCANS_SOCKET and headers.get('upgrade', '').lower() == 'websocket':
+                    await self.websocket(reader, writer, headers)
+                    return
+                keep = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                if method not in ('GET', 'HEAD') or 'content-length' in headers or 'transfer-encoding' in headers:
+                    # There is nothing to upload to; don't try to skip the body
+                    self.send(writer, '405 Method Not Allowed', [('Allow', 'GET, HEAD')], keep=False)
+                    return
+                self.respond(writer, path, headers, method == 'HEAD', keep)
+                await writer.drain()
+                if not keep:
+                    return
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    def respond(self, writer, path, headers, head, keep):
+        if path == SCAN_PATH:
+            if self.scan is None:
+                return self.send(writer, '404 Not Found', keep=keep)
+            data, etag = self.scan
+        elif path in STATIC_FILES:
+            try:
+                with open(os.path.join(self.root, STATIC_FILES[path]), 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    data = f.read()
+            except OSError:
+                return self.send(writer, '404 Not Found', keep=keep)
+            etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        else:
+            return self.send(writer, '404 Not Found', keep=keep)
+        ext = os.path.splitext(STATIC_FILES.get(path, path))[1]
+        out = [('Content-Type', CONTENT_TYPES.get(ext, 'application/octet-stream')),
+               ('ETag', etag), ('Cache-Control', 'no-cache'), ('Accept-Ranges', 'bytes')]
+        # Clients that already have this version only need to be told so
+        if etag in [t.strip() for t in headers.get('if-none-match', '').split(',')] or headers.get('if-none-match') == '*':
+            return self.send(writer, '304 Not Modified', out, keep=keep)
+        r = None
+        if 'range' in headers and headers.get('if-range', etag) == etag:
+            r = parse_range(headers['range'], len(data))
+        if r is False:
+            out.append(('Content-Range', 'bytes */%d' % len(data)))
+            return self.send(writer, '416 Range Not Satisfiable', out, keep=keep)
+        if r:
+            start, end = r
+            out.append(('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, len(data))))
+            return self.send(writer, '206 Partial Content', out, memoryview(data)[start:end], head, keep)
+        self.send(writer, '200 OK', out, data, head, keep)
+
+    def send(self, writer, status, headers=[], body=b'', head=False, keep=True):
+        lines = ['HTTP/1.1 ' + status] + ['%s: %s' % h for h in headers]
+        if not status.startswith('304'):
+            lines.append('Content-Length: %d' % len(body))
+        lines.append('Connection: ' + ('keep-alive' if keep else 'close'))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if body and not head:
+            writer.write(body)
+
+
+
+    # WebSocket
+
+    async def websocket(self, reader, writer, headers):
+        # Tell the client about the latest scan now, and about every new one as
+        # it comes in. Anything the client sends, other than pings, is ignored.
+        key = headers.get('sec-websocket-key')
+        if not key:
+            self.send(writer, '400 Bad Request', keep=False)
+            return
+        accept = base64.b64encode(hashlib.sha1(key.encode('latin-1') + WS_GUID).digest())
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        self.sockets.add(writer)
+        try:
+            if self.scan is not None:
+                writer.write(ws_frame(scan_message(self.scan)))
+            while True:
+                opcode, payload = await read_frame(reader)
+                if opcode == 8: # Close
+                    writer.write(ws_frame(payload[:2], 8))
+                    return
+                elif opcode == 9: # Ping
+                    writer.write(ws_frame(payload, 10))
+                await writer.drain()
+        finally:
+            self.sockets.discard(writer)
+
+    def announce(self, scan):
+        frame = ws_frame(scan_message(scan))
+        for writer in list(self.sockets):
+            if writer.is_closing():
+                self.sockets.discard(writer)
+            else:
+                writer.write(frame)
+
+
+
+
+
+# Helper functions for ScanServer
+
+def parse_range(header, size):
+    # Parse the Range header of a request for size bytes. Returns (start, end)
+    # for a single range, False if the range cannot be satisfied, or None if
+    # the whole file should be sent (including for multiple ranges).
+    m = re.match(r'bytes=(\d*)-(\d*)$', header.strip())
+    if not m or not (m.group(1) or m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = min(int(m.group(2)) + 1, size) if m.group(2) else size
+    else:
+        # Suffix range: the last n bytes
+        start = max(size - int(m.group(2)), 0)
+        end = size
+    if start >= end:
+        return False
+    return start, end
+
+
+def scan_message(scan):
+    data, etag = scan
+    return json.dumps({'path': SCAN_PATH, 'etag': etag, 'size': len(data)}).encode('utf-8')
+
+
+def ws_frame(payload, opcode=1):
+    # Build an unmasked, unfragmented WebSocket frame (a text message by default)
+    n = len(payload)
+    if n < 126:
+        head = struct.pack('>BB', 0x80 | opcode, n)
+    elif n < 65536:
+        head = struct.pack('>BBH', 0x80 | opcode, 126, n)
+    else:
+        head = struct.pack('>BBQ', 0x80 | opcode, 127, n)
+    return head + payload
+
+
+async def read_frame(reader):
+    # Read a WebSocket frame from a client. Returns (opcode, payload).
+    b0, b1 = await reader.readexactly(2)
+    n = b1 & 127
+    if n == 126:
+        n, = struct.unpack('>H', await reader.readexactly(2))
+    elif n == 127:
+        n, = struct.unpack('>Q', await reader.readexactly(8))
+    if n > MAX_REQUEST:
+        raise ConnectionError('WebSocket message too long')
+    mask = await reader.readexactly(4) if b1 & 128 else None
+    payload = await reader.readexactly(n)
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return b0 & 15, payload
+
+
+
+
+
+# Serve the remote application locally, for testing:
+#   python -m DLPScanner.wifi [root [pointcloud.pcd]]
+# where root is the folder holding client/ (and node_modules/, if installed).
+if __name__ == '__main__':
+    server = ScanServer(sys.argv[1] if len(sys.argv) > 1 else SOCKETS_DIR)
+    server.start()
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'rb') as f:
+            server.publish(f.read())
+    print('Serving on port %d' % server.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
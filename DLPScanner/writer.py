@@ -0,0 +1,94 @@
+# Background file writer
+# ECEN 404
+
+# Used by cvstereo.py to save the debug captures (images, disparity maps and
+# pointclouds) on a pool of worker threads, so that the scan does not have to
+# wait for the files to be encoded and written.
+
+import cv2
+import numpy
+import os
+import queue
+import threading
+
+from .pcd import *
+
+
+WRITER_THREADS = 2        # Default number of worker threads
+WRITER_QUEUE = 64         # Default maximum number of pending files before put() blocks
+DEFAULT_COMPRESSION = 3   # Default PNG compression level, the same as OpenCV's
+
+
+
+class FileWriter(object):
+
+    def __init__(self, threads=WRITER_THREADS, size=WRITER_QUEUE, compression=DEFAULT_COMPRESSION, raw=False, verbose=True):
+        # compression is the PNG compression level, from 0 (none, fastest) to 9
+        # (smallest). If raw is set, images are saved uncompressed in .npy format
+        # instead. With threads = 0, every file is written immediately by put().
+        self.compression = compression
+        self.raw = raw
+        self.verbose = verbose
+        self.queue = queue.Queue(size)
+        self.threads = [threading.Thread(target=self.loop, daemon=True) for i in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        # Finish writing everything that is queued, and stop the workers
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def flush(self):
+        # Wait until everything that is queued has been written
+        self.queue.join()
+
+    def loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+            finally:
+                self.queue.task_done()
+
+    def write(self, path, func, args):
+        try:
+            func(path, *args)
+            if self.verbose:
+                print('Saved %s' % path)
+        except Exception as e:
+            # A failed debug file should never bring down the scanner
+            print('Error saving %s: %r' % (path, e))
+
+    def put(self, path, func, *args):
+        # Queue func(path, *args) to be called by a worker. This blocks while
+        # the queue is full, so a slow disk holds up the caller rather than
+        # using up all the memory. The arguments must not be modified until
+        # flush() has been called.
+        if self.threads:
+            self.queue.put((path, func, args))
+        else:
+            self.write(path, func, args)
+
+    # The arrays passed to these are not copied (see put()).
+
+    def save_image(self, path, image):
+        # Save an image. path should end in .png; with raw set, it is saved
+        # with .npy in its place.
+        if self.raw:
+            self.put(os.path.splitext(path)[0] + '.npy', numpy.save, image)
+        else:
+            self.put(path, self.imwrite, image)
+
+    def imwrite(self, path, image):
+        assert cv2.imwrite(path, image, [cv2.IMWRITE_PNG_COMPRESSION, self.compression]), 'Could not write image'
+
+    def save_array(self, path, array):
+        self.put(path, numpy.save, array)
+
+    def save_pcd(self, path, pointcloud, binary=True):
+        self.put(path, lambda path, pointcloud: save_pcd(pointcloud, path, binary), pointcloud)
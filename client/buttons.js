@@ -74,4 +74,12 @@ function downloadFile(){
         download(text,"export.pcd",".txt");
 }
 
+//Load each new scan as soon as the scanner announces it
+//(only served by the Python scan server; with the node server this socket just fails to connect)
+if (window.WebSocket) {
+    var scans = new WebSocket((location.protocol == 'https:' ? 'wss://' : 'ws://') + location.host + '/scans');
+    scans.onmessage = function(e){
+        checkFiles();
+    };
+}
 